@@ -0,0 +1,345 @@
+"""Микробенчмарки методов Database на синтетической партнёрской сети.
+
+Генерирует users / referrals / payouts с перекосом в сторону нескольких
+супер-рефереров (распределение Ципфа), замеряет задержку методов Database
+и сохраняет результат в JSON. С --compare сравнивает с прошлым прогоном
+и отмечает методы, которые стали медленнее.
+
+    python -m benchmarks.db_benchmark --users 1000000 --referrals 10000000 --payouts 500000 \\
+        --database-url sqlite+aiosqlite:///bench.db --save baseline.json
+    python -m benchmarks.db_benchmark --database-url sqlite+aiosqlite:///bench.db --compare baseline.json
+
+База генерируется, только если таблица users пуста, поэтому большой датасет
+можно создать один раз и переиспользовать. Пишущие методы (add_referral,
+create_payout_request, ...) немного меняют данные при каждом прогоне.
+"""
+import argparse
+import asyncio
+import bisect
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, select
+
+from database import Database, Payout, Referral, User, rebuild_partner_stats, rebuild_referral_tree
+
+CHUNK_SIZE = 50000
+FIRST_USER_ID = 1000000
+PAYOUT_STATUSES = ('pending', 'approved', 'rejected', 'paid')
+PAYOUT_STATUS_WEIGHTS = (0.1, 0.3, 0.1, 0.5)
+
+
+class SkewedNetwork:
+    """Выбор рефереров с перекосом: вес партнёра ранга k пропорционален 1 / k^skew"""
+
+    def __init__(self, user_ids, referrer_share=0.2, skew=1.1, seed=42):
+        self.random = random.Random(seed)
+        self.user_ids = user_ids
+        referrers = max(1, int(len(user_ids) * referrer_share))
+        # Супер-рефереры - первые по рангу, остальные партнёры почти никого не приводят
+        self.referrers = self.user_ids[:referrers]
+        self._cum_weights = list(itertools.accumulate(1 / (rank ** skew) for rank in range(1, referrers + 1)))
+
+    def referrer(self):
+        point = self.random.random() * self._cum_weights[-1]
+        return self.referrers[bisect.bisect_left(self._cum_weights, point)]
+
+    def hot_referrers(self, count=10):
+        return self.referrers[:count]
+
+    def cold_user(self):
+        return self.random.choice(self.user_ids)
+
+
+def _chunks(rows):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= CHUNK_SIZE:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def generate_dataset(connection, network, referrals, payouts):
+    """Заполняет пустую базу (синхронное соединение, run_sync)"""
+    rnd = network.random
+    start = datetime.now() - timedelta(days=365)
+
+    def users():
+        for user_id in network.user_ids:
+            signed = rnd.random() < 0.6
+            created_at = start + timedelta(seconds=rnd.randrange(365 * 86400))
+            yield {
+                'user_id': user_id,
+                'username': f"partner{user_id}",
+                'first_name': f"Partner{user_id}",
+                'referral_link': f"ref_{user_id}_{rnd.getrandbits(64):016x}",
+                'signed_agreement': signed,
+                'signed_at': created_at if signed else None,
+                'created_at': created_at,
+                'blocked_at': created_at if rnd.random() < 0.03 else None
+            }
+
+    def referred_ids():
+        # Сначала приглашаются сами пользователи, и реферер всегда пришёл раньше
+        # приглашённого - так рефереры тоже оказываются в чужой структуре и дерево
+        # получается многоуровневым, без циклов. Приглашённые сверх этого - лиды,
+        # которые ещё не открыли бота; их id идут после id пользователей
+        rank = {user_id: index for index, user_id in enumerate(network.referrers)}
+        for index, user_id in enumerate(network.user_ids):
+            referrer_id = network.referrer()
+            if rank[referrer_id] < index:
+                yield referrer_id, user_id
+        for referred_id in itertools.count(max(network.user_ids) + 1):
+            yield network.referrer(), referred_id
+
+    def referral_rows():
+        # Каждого приглашённого приводит ровно один реферер
+        for referrer_id, referred_id in itertools.islice(referred_ids(), referrals):
+            registered_at = start + timedelta(seconds=rnd.randrange(365 * 86400))
+            confirmed = rnd.random() < 0.4
+            yield {
+                'referrer_id': referrer_id,
+                'referred_id': referred_id,
+                'confirmed': confirmed,
+                'registered_at': registered_at,
+                'confirmed_at': registered_at if confirmed else None
+            }
+
+    def payout_rows():
+        for _ in range(payouts):
+            status = rnd.choices(PAYOUT_STATUSES, PAYOUT_STATUS_WEIGHTS)[0]
+            requested_at = start + timedelta(seconds=rnd.randrange(365 * 86400))
+            yield {
+                'user_id': network.referrer(),
+                'amount': float(rnd.randrange(1000, 50000, 500)),
+                'status': status,
+                'requested_at': requested_at,
+                'processed_at': None if status == 'pending' else requested_at,
+                'payment_method': rnd.choice(('card', 'sbp')),
+                'details': "4276 0000 0000 0000"
+            }
+
+    for table, rows in ((User.__table__, users()), (Referral.__table__, referral_rows()),
+                        (Payout.__table__, payout_rows())):
+        started = time.perf_counter()
+        inserted = 0
+        for chunk in _chunks(rows):
+            connection.execute(table.insert(), chunk)
+            inserted += len(chunk)
+        logging.info(f"{table.name}: {inserted} строк за {time.perf_counter() - started:.1f} с")
+
+    rebuild_partner_stats(connection)
+    rebuild_referral_tree(connection)
+
+
+class DatabaseBenchmark:
+    def __init__(self, db, network, dataset, iterations):
+        self.db = db
+        self.network = network
+        self.dataset = dataset
+        self.iterations = iterations
+        # Новые приглашённые не пересекаются ни с датасетом, ни с прошлыми прогонами
+        self._referred_ids = itertools.count(-time.time_ns() // 1000, -1)
+
+    def _uncached(self):
+        # Замеряем запросы к БД, а не попадания в кэш партнёров
+        self.db.user_cache.clear()
+        self.db.link_cache.clear()
+
+    async def _pick_payout_ids(self, count):
+        async with self.db.Session() as session:
+            max_id = await session.scalar(select(func.max(Payout.id))) or 0
+        return [self.network.random.randint(1, max_id) for _ in range(count)] if max_id else []
+
+    async def _referral_links(self, user_ids):
+        async with self.db.Session() as session:
+            return list(await session.scalars(select(User.referral_link).where(User.user_id.in_(user_ids))))
+
+    async def cases(self):
+        """(имя, фабрика корутины, число повторов)"""
+        net = self.network
+        hot = net.hot_referrers()
+        links = await self._referral_links([net.cold_user() for _ in range(self.iterations)]) or [None]
+        payout_ids = await self._pick_payout_ids(self.iterations) or [0]
+        iterations = self.iterations
+        heavy = max(1, iterations // 10)
+        referrals = max(1, self.dataset['referrals'])
+
+        def get_user():
+            self._uncached()
+            return self.db.get_user(net.cold_user())
+
+        def get_user_by_referral_link():
+            self._uncached()
+            return self.db.get_user_by_referral_link(net.random.choice(links))
+
+        async def add_and_confirm():
+            referred_id = next(self._referred_ids)
+            await self.db.add_referral(net.referrer(), referred_id)
+            await self.db.confirm_referral(referred_id)
+
+        return [
+            ('get_user', get_user, iterations),
+            ('get_user_by_referral_link', get_user_by_referral_link, iterations),
+            ('get_user_stats[hot]', lambda: self.db.get_user_stats(net.random.choice(hot)), iterations),
+            ('get_user_stats[cold]', lambda: self.db.get_user_stats(net.cold_user()), iterations),
+            ('add_referral', lambda: self.db.add_referral(net.referrer(), next(self._referred_ids)), iterations),
+            ('confirm_referral', lambda: self.db.confirm_referral(net.random.randint(1, referrals)), iterations),
+            ('add_and_confirm_referral', add_and_confirm, iterations),
+            ('get_referrals_by_referred', lambda: self.db.get_referrals_by_referred(net.cold_user()), iterations),
+            ('get_user_payouts[hot]', lambda: self.db.get_user_payouts(net.random.choice(hot)), iterations),
+            ('get_user_payouts_page[hot]',
+             lambda: self.db.get_user_payouts_page(net.random.choice(hot)), iterations),
+            ('create_payout_request',
+             lambda: self.db.create_payout_request(net.referrer(), 1000, 'card', "bench"), iterations),
+            ('update_payout_status',
+             lambda: self.db.update_payout_status(net.random.choice(payout_ids), 'pending'), iterations),
+            ('get_pending_payouts', self.db.get_pending_payouts, heavy),
+            ('get_pending_payouts_page',
+             lambda: self.db.get_pending_payouts_page(after_id=net.random.choice(payout_ids)), iterations),
+            ('get_all_users[limit=5]', lambda: self.db.get_all_users(limit=5), iterations),
+            ('get_all_users[signed]', lambda: self.db.get_all_users(signed_only=True), heavy),
+            ('get_audience_counts', self.db.get_audience_counts, heavy),
+        ]
+
+    async def run(self, only=None):
+        results = {}
+        for name, factory, repeat in await self.cases():
+            if only and not any(pattern in name for pattern in only):
+                continue
+            timings = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                await factory()
+                timings.append(time.perf_counter() - started)
+            results[name] = summarize(timings)
+            print_row(name, results[name])
+        return results
+
+
+def summarize(timings):
+    timings = sorted(timings)
+
+    def at(fraction):
+        return timings[min(len(timings) - 1, int(round(fraction * (len(timings) - 1))))] * 1000
+
+    return {
+        'count': len(timings),
+        'mean_ms': statistics.fmean(timings) * 1000,
+        'p50_ms': at(0.50),
+        'p95_ms': at(0.95),
+        'max_ms': timings[-1] * 1000
+    }
+
+
+def print_row(name, row, baseline=None, threshold=0.2):
+    line = (f"{name:<30}{row['count']:>7}{row['mean_ms']:>10.2f}{row['p50_ms']:>10.2f}"
+            f"{row['p95_ms']:>10.2f}{row['max_ms']:>10.2f}")
+    if baseline:
+        ratio = row['p50_ms'] / baseline['p50_ms'] if baseline['p50_ms'] else 1
+        marker = "⚠️" if ratio > 1 + threshold else ("🚀" if ratio < 1 - threshold else "")
+        line += f"{ratio:>9.2f}x {marker}"
+    print(line)
+
+
+def compare(results, baseline, threshold):
+    """Печатает сравнение с прошлым прогоном, возвращает список деградировавших методов"""
+    print(f"\nСравнение p50 с базовым прогоном от {baseline.get('created_at', '?')} "
+          f"(dataset: {baseline.get('dataset')})")
+    regressions = []
+    for name, row in results.items():
+        base = baseline['results'].get(name)
+        print_row(name, row, base, threshold)
+        if base and base['p50_ms'] and row['p50_ms'] / base['p50_ms'] > 1 + threshold:
+            regressions.append(name)
+    return regressions
+
+
+async def dataset_size(db):
+    async with db.Session() as session:
+        return {
+            'users': await session.scalar(select(func.count(User.id))),
+            'referrals': await session.scalar(select(func.count(Referral.id))),
+            'payouts': await session.scalar(select(func.count(Payout.id)))
+        }
+
+
+async def run_benchmark(args):
+    database_url = args.database_url or \
+        f"sqlite+aiosqlite:///{os.path.join(tempfile.mkdtemp(prefix='partner_bot_bench_'), 'bench.db')}"
+    db = Database(database_url)
+    await db.init()
+    try:
+        # Если датасет уже есть, бенчмарк работает с его пользователями
+        async with db.Session() as session:
+            user_ids = list(await session.scalars(select(User.user_id).order_by(User.id)))
+        if not user_ids:
+            print(f"🧪 Генерация: {args.users} пользователей, {args.referrals} рефералов, {args.payouts} выплат")
+            user_ids = [FIRST_USER_ID + i for i in range(args.users)]
+            network = SkewedNetwork(user_ids, args.referrer_share, args.skew, args.seed)
+            async with db.engine.begin() as conn:
+                await conn.run_sync(generate_dataset, network, args.referrals, args.payouts)
+        network = SkewedNetwork(user_ids, args.referrer_share, args.skew, args.seed)
+
+        dataset = await dataset_size(db)
+        print(f"📦 Датасет: {dataset}\n")
+        print(f"{'Метод':<30}{'кол-во':>7}{'mean мс':>10}{'p50 мс':>10}{'p95 мс':>10}{'max мс':>10}")
+        results = await DatabaseBenchmark(db, network, dataset, args.iterations).run(args.only)
+    finally:
+        await db.close()
+
+    report = {
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'database': db.engine.dialect.name,
+        'python': platform.python_version(),
+        'dataset': dataset,
+        'results': results
+    }
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n💾 Результаты сохранены в {args.save}")
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"\n⚠️ Медленнее базового прогона более чем на {args.threshold:.0%}: {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк методов Database на синтетических данных")
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--referrals', type=int, default=1000000)
+    parser.add_argument('--payouts', type=int, default=50000)
+    parser.add_argument('--referrer-share', type=float, default=0.2, help="Доля пользователей-рефереров")
+    parser.add_argument('--skew', type=float, default=1.1, help="Показатель Ципфа для рефереров")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--iterations', type=int, default=200, help="Повторов на метод")
+    parser.add_argument('--only', nargs='*', help="Запустить только методы, содержащие эти подстроки")
+    parser.add_argument('--database-url', default=None, help="По умолчанию - временная SQLite база")
+    parser.add_argument('--save', default=None, help="Сохранить результаты в JSON")
+    parser.add_argument('--compare', default=None, help="JSON прошлого прогона для сравнения")
+    parser.add_argument('--threshold', type=float, default=0.2, help="Допустимое замедление p50")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(message)s', level=logging.INFO)
+    raise SystemExit(asyncio.run(run_benchmark(args)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+"""Локальная замена Telegram Bot API для нагрузочного тестирования.
+
+Поддерживает getMe, getUpdates (long polling), sendMessage, editMessageText,
+answerCallbackQuery; остальные методы отвечают {"ok": true, "result": true}.
+Задержка ответа, доля ошибок и 429 (flood wait) настраиваются.
+
+Запуск отдельно (бот подключается через BOT_API_BASE_URL=http://127.0.0.1:8081/bot):
+    python -m benchmarks.fake_bot_api --port 8081 --latency-ms 40 --flood-rate 0.01
+
+Служебные эндпоинты:
+    POST /control/updates - добавить апдейт (или список) в очередь getUpdates
+    GET  /control/stats   - счётчики вызовов по методам
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
+
+BOT_USER = {"id": 100000, "is_bot": True, "first_name": "FakeBot", "username": "fake_partner_bot"}
+
+
+class FakeBotApi:
+    """Состояние фейкового сервера: очередь апдейтов, счётчики и параметры отказов"""
+
+    def __init__(self, latency_ms=0, jitter_ms=0, error_rate=0.0, flood_rate=0.0,
+                 max_rps=None, retry_after=1):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.flood_rate = flood_rate
+        self.max_rps = max_rps
+        self.retry_after = retry_after
+
+        self.calls = Counter()
+        self.errors = Counter()
+        self._updates = []
+        self._update_id = 0
+        self._condition = threading.Condition()
+        self._message_id = 0
+        self._send_window = []  # время отправок за последнюю секунду (для max_rps)
+        self._lock = threading.Lock()
+
+    def push_updates(self, updates):
+        with self._condition:
+            for update in updates:
+                self._update_id += 1
+                update.setdefault('update_id', self._update_id)
+                self._updates.append(update)
+            self._condition.notify_all()
+
+    def get_updates(self, offset=0, timeout=0, limit=100):
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            self._updates = [u for u in self._updates if u['update_id'] >= offset]
+            while not self._updates and time.monotonic() < deadline:
+                self._condition.wait(deadline - time.monotonic())
+            return self._updates[:limit]
+
+    def _over_rate_limit(self):
+        if not self.max_rps:
+            return False
+        now = time.monotonic()
+        with self._lock:
+            self._send_window = [t for t in self._send_window if t > now - 1]
+            if len(self._send_window) >= self.max_rps:
+                return True
+            self._send_window.append(now)
+            return False
+
+    def _message(self, params):
+        with self._lock:
+            self._message_id += 1
+            message_id = self._message_id
+        chat_id = int(params.get('chat_id', 0))
+        return {
+            "message_id": int(params.get('message_id', message_id)),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+            "text": params.get('text', '')
+        }
+
+    def handle(self, method, params):
+        """Возвращает (HTTP-статус, тело ответа)"""
+        self.calls[method] += 1
+
+        if method == 'getUpdates':
+            updates = self.get_updates(
+                int(params.get('offset', 0)),
+                float(params.get('timeout', 0)),
+                int(params.get('limit', 100))
+            )
+            return 200, {"ok": True, "result": updates}
+
+        delay = self.latency_ms + random.uniform(0, self.jitter_ms)
+        if delay:
+            time.sleep(delay / 1000)
+
+        if method in ('sendMessage', 'editMessageText'):
+            if random.random() < self.flood_rate or self._over_rate_limit():
+                self.errors['429'] += 1
+                return 429, {
+                    "ok": False, "error_code": 429,
+                    "description": f"Too Many Requests: retry after {self.retry_after}",
+                    "parameters": {"retry_after": self.retry_after}
+                }
+            if random.random() < self.error_rate:
+                self.errors['500'] += 1
+                return 500, {"ok": False, "error_code": 500, "description": "Internal Server Error"}
+
+        if method == 'getMe':
+            return 200, {"ok": True, "result": BOT_USER}
+        if method in ('sendMessage', 'editMessageText'):
+            return 200, {"ok": True, "result": self._message(params)}
+        return 200, {"ok": True, "result": True}
+
+    def stats(self):
+        return {"calls": dict(self.calls), "errors": dict(self.errors)}
+
+
+def _make_handler(api):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def _params(self):
+            parsed = urlparse(self.path)
+            params = dict(parse_qsl(parsed.query))
+            length = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(length) if length else b''
+            if body:
+                if 'application/json' in (self.headers.get('Content-Type') or ''):
+                    params.update(json.loads(body))
+                else:
+                    params.update(parse_qsl(body.decode()))
+            return parsed.path, params
+
+        def _reply(self, status, payload):
+            data = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _dispatch(self):
+            path, params = self._params()
+            if path == '/control/stats':
+                return self._reply(200, api.stats())
+            # /bot<token>/<method>
+            method = path.rsplit('/', 1)[-1]
+            status, payload = api.handle(method, params)
+            self._reply(status, payload)
+
+        def do_POST(self):
+            if self.path.startswith('/control/updates'):
+                length = int(self.headers.get('Content-Length') or 0)
+                data = json.loads(self.rfile.read(length) or b'[]')
+                api.push_updates(data if isinstance(data, list) else [data])
+                return self._reply(200, {"ok": True})
+            self._dispatch()
+
+        do_GET = _dispatch
+
+    return Handler
+
+
+def start_server(api, host='127.0.0.1', port=0):
+    """Запускает сервер в фоновом потоке, возвращает (server, base_url для ApplicationBuilder.base_url)"""
+    server = ThreadingHTTPServer((host, port), _make_handler(api))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address[:2]
+    return server, f"http://{host}:{port}/bot"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Фейковый Telegram Bot API для нагрузочных тестов")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--jitter-ms', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Доля ответов 500")
+    parser.add_argument('--flood-rate', type=float, default=0.0, help="Доля ответов 429")
+    parser.add_argument('--max-rps', type=int, default=None, help="Больше отправок в секунду -> 429")
+    args = parser.parse_args()
+
+    api = FakeBotApi(args.latency_ms, args.jitter_ms, args.error_rate, args.flood_rate, args.max_rps)
+    server, base_url = start_server(api, args.host, args.port)
+    print(f"🧪 Fake Bot API: {base_url} (BOT_API_BASE_URL={base_url})")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+"""Нагрузочный тест PartnerBot на фейковом Bot API.
+
+Симулирует N партнёров: /start по реферальной ссылке, подписание соглашения,
+статистика, выплаты и попытка запросить выплату. Апдейты проходят через
+тот же UserOrderedUpdateProcessor, что и в боевом режиме. Выводит p50/p95/p99
+задержки по каждому обработчику и общую пропускную способность.
+
+    python -m benchmarks.load_test --partners 500 --concurrency 100 --latency-ms 30
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import tempfile
+import time
+from collections import defaultdict
+
+from telegram import Update
+
+from benchmarks.fake_bot_api import BOT_USER, FakeBotApi, start_server
+from config import Config
+
+SEED_PARTNER_ID = 1000
+FIRST_PARTNER_ID = 100000
+
+
+class LoadTest:
+    def __init__(self, bot):
+        self.bot = bot
+        self.application = bot.application
+        self.latencies = defaultdict(list)
+        self._ids = itertools.count(1)
+
+    def _user(self, user_id):
+        return {"id": user_id, "is_bot": False, "first_name": f"Partner{user_id}", "username": f"partner{user_id}"}
+
+    def command(self, user_id, text):
+        update_id = next(self._ids)
+        command = text.split()[0]
+        return {"update_id": update_id, "message": {
+            "message_id": update_id, "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"}, "from": self._user(user_id), "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(command)}]
+        }}
+
+    def text(self, user_id, text):
+        update_id = next(self._ids)
+        return {"update_id": update_id, "message": {
+            "message_id": update_id, "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"}, "from": self._user(user_id), "text": text
+        }}
+
+    def callback(self, user_id, data):
+        update_id = next(self._ids)
+        return {"update_id": update_id, "callback_query": {
+            "id": str(update_id), "chat_instance": str(user_id), "data": data, "from": self._user(user_id),
+            "message": {"message_id": 1, "date": int(time.time()), "chat": {"id": user_id, "type": "private"},
+                        "from": BOT_USER, "text": "menu"}
+        }}
+
+    async def dispatch(self, route, data):
+        update = Update.de_json(data, self.application.bot)
+        started = time.perf_counter()
+        await self.application.update_processor.process_update(update, self.application.process_update(update))
+        self.latencies[route].append(time.perf_counter() - started)
+
+    async def partner_journey(self, user_id, referral_link):
+        await self.dispatch('command:/start ref', self.command(user_id, f"/start {referral_link}"))
+        await self.dispatch('callback:sign_agreement', self.callback(user_id, 'sign_agreement'))
+        await self.dispatch('callback:confirm_agreement', self.callback(user_id, 'confirm_agreement'))
+        await self.dispatch('callback:stats', self.callback(user_id, 'stats'))
+        await self.dispatch('callback:payouts', self.callback(user_id, 'payouts'))
+        await self.dispatch('callback:request_payout', self.callback(user_id, 'request_payout'))
+        await self.dispatch('callback:method_card', self.callback(user_id, 'method_card'))
+        await self.dispatch('message:payout_details', self.text(user_id, "4276 0000 0000 0000\n1000"))
+        await self.dispatch('command:/stats', self.command(user_id, "/stats"))
+
+    async def run(self, partners, concurrency):
+        # Партнёр, по ссылке которого приходят все участники теста
+        await self.dispatch('command:/start', self.command(SEED_PARTNER_ID, "/start"))
+        await self.dispatch('callback:confirm_agreement', self.callback(SEED_PARTNER_ID, 'confirm_agreement'))
+        referral_link = (await self.bot.db.get_user(SEED_PARTNER_ID)).referral_link
+        self.latencies.clear()
+
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def limited(user_id):
+            async with semaphore:
+                await self.partner_journey(user_id, referral_link)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(limited(FIRST_PARTNER_ID + i) for i in range(partners)))
+        return time.perf_counter() - started
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0
+    return sorted_values[min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))]
+
+
+def summarize(latencies, elapsed):
+    report = {'elapsed_s': elapsed, 'routes': {}}
+    total = 0
+    for route, values in sorted(latencies.items()):
+        values = sorted(values)
+        total += len(values)
+        report['routes'][route] = {
+            'count': len(values),
+            'p50_ms': percentile(values, 0.50) * 1000,
+            'p95_ms': percentile(values, 0.95) * 1000,
+            'p99_ms': percentile(values, 0.99) * 1000,
+            'max_ms': values[-1] * 1000
+        }
+    report['updates'] = total
+    report['updates_per_s'] = total / elapsed if elapsed else 0
+    return report
+
+
+def print_report(report, api_stats):
+    print(f"\n{'Обработчик':<30}{'кол-во':>8}{'p50 мс':>10}{'p95 мс':>10}{'p99 мс':>10}{'max мс':>10}")
+    for route, row in report['routes'].items():
+        print(f"{route:<30}{row['count']:>8}{row['p50_ms']:>10.1f}{row['p95_ms']:>10.1f}"
+              f"{row['p99_ms']:>10.1f}{row['max_ms']:>10.1f}")
+    print(f"\n📊 Апдейтов: {report['updates']} за {report['elapsed_s']:.2f} с "
+          f"({report['updates_per_s']:.1f} апдейтов/с)")
+    print(f"🧪 Вызовы Bot API: {api_stats['calls']}, ошибки: {api_stats['errors']}")
+
+
+async def run_load_test(args):
+    api = FakeBotApi(args.latency_ms, args.jitter_ms, args.error_rate, args.flood_rate, args.max_rps)
+    server, base_url = start_server(api)
+
+    workdir = tempfile.mkdtemp(prefix='partner_bot_load_')
+    Config.DATABASE_URL = args.database_url or f"sqlite+aiosqlite:///{os.path.join(workdir, 'load.db')}"
+    Config.CONCURRENT_UPDATES = args.concurrency
+
+    from main import PartnerBot
+    bot = PartnerBot('123456:LOADTEST', base_url=base_url)
+    application = bot.application
+    await application.initialize()
+    await application.post_init(application)
+    try:
+        load_test = LoadTest(bot)
+        elapsed = await load_test.run(args.partners, args.concurrency)
+        report = summarize(load_test.latencies, elapsed)
+    finally:
+        await application.post_stop(application)
+        await application.shutdown()
+        await application.post_shutdown(application)
+        server.shutdown()
+
+    print_report(report, api.stats())
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'args': vars(args), 'report': report, 'api': api.stats()}, f, ensure_ascii=False, indent=2)
+        print(f"💾 Результаты сохранены в {args.output}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест PartnerBot на фейковом Bot API")
+    parser.add_argument('--partners', type=int, default=200, help="Число симулируемых партнёров")
+    parser.add_argument('--concurrency', type=int, default=50, help="Партнёров одновременно")
+    parser.add_argument('--latency-ms', type=float, default=20, help="Задержка ответа Bot API")
+    parser.add_argument('--jitter-ms', type=float, default=10)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--flood-rate', type=float, default=0.0)
+    parser.add_argument('--max-rps', type=int, default=None)
+    parser.add_argument('--database-url', default=None, help="По умолчанию - временная SQLite база")
+    parser.add_argument('--output', default=None, help="Сохранить отчёт в JSON")
+    args = parser.parse_args()
+
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+    asyncio.run(run_load_test(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,329 @@
+import asyncio
+import logging
+import time
+
+import httpx
+from telegram.error import BadRequest, Forbidden, RetryAfter
+
+import metrics
+from messages import Messages
+
+
+class TokenBucket:
+    """Ограничитель скорости: не более rate операций в секунду, всплеск до capacity"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1, int(rate))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        """Flood wait: никто не получает токены ближайшие seconds секунд"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+        # Пауза не копит токены: пополнение считается с её конца, без всплеска сразу после
+        self._updated = self._paused_until
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class BroadcastEngine:
+    """Отправка сообщений пулом воркеров в пределах лимитов Telegram.
+
+    Общий лимит бота (~30 сообщений/с в разные чаты) соблюдается через
+    TokenBucket, один на все рассылки бота. Лимит на один чат (~1 сообщение/с)
+    - через интервал между отправками в тот же chat_id. На RetryAfter все
+    воркеры ждут указанное Telegram время, затем сообщение отправляется повторно.
+    """
+
+    def __init__(self, bucket, workers=10, per_chat_interval=1.0, max_retry_after=3):
+        self.bucket = bucket
+        self.workers = workers
+        self.per_chat_interval = per_chat_interval
+        self.max_retry_after = max_retry_after
+        self._chat_next_send = {}
+
+        # Текущее состояние для прогресса и метрик
+        self.queued = 0
+        self.sent = 0
+        self.failed = 0
+        self.running = False
+        self.started_at = None
+
+    async def _wait_for_chat(self, chat_id):
+        now = time.monotonic()
+        # Чаты лежат в порядке последней отправки: записи с наступившим временем
+        # снимаются с начала, и карта держит только чаты последних секунд, а не всю аудиторию
+        while self._chat_next_send:
+            oldest = next(iter(self._chat_next_send))
+            if self._chat_next_send[oldest] > now:
+                break
+            del self._chat_next_send[oldest]
+        next_send = self._chat_next_send.pop(chat_id, 0)
+        self._chat_next_send[chat_id] = max(now, next_send) + self.per_chat_interval
+        if next_send > now:
+            await asyncio.sleep(next_send - now)
+
+    async def _deliver(self, chat_id, send):
+        """Возвращает None при успехе или последнее исключение"""
+        for attempt in range(self.max_retry_after + 1):
+            await self._wait_for_chat(chat_id)
+            await self.bucket.acquire()
+            try:
+                await send(chat_id)
+                return None
+            except RetryAfter as e:
+                logging.warning(f"Flood wait {e.retry_after}s при отправке в {chat_id}")
+                self.bucket.pause(e.retry_after)
+                error = e
+            except Exception as e:
+                return e
+        return error
+
+    async def _worker(self, queue, send, on_result):
+        while True:
+            chat_id = await queue.get()
+            try:
+                error = await self._deliver(chat_id, send)
+                if error is None:
+                    self.sent += 1
+                else:
+                    self.failed += 1
+                if on_result:
+                    await on_result(chat_id, error)
+            except Exception as e:
+                logging.error(f"Ошибка воркера рассылки для {chat_id}: {e}")
+            finally:
+                self.queued -= 1
+                queue.task_done()
+
+    async def run(self, chat_ids, send, on_result=None):
+        """Отправляет send(chat_id) каждому получателю.
+
+        chat_ids - обычный или асинхронный итератор id, читается по мере отправки.
+        on_result(chat_id, error) вызывается после каждой попытки доставки
+        (error is None при успехе). Возвращает (sent, failed).
+        """
+        self.queued = self.sent = self.failed = 0
+        self.running = True
+        self.started_at = time.monotonic()
+        queue = asyncio.Queue(maxsize=self.workers * 4)
+        workers = [asyncio.create_task(self._worker(queue, send, on_result)) for _ in range(self.workers)]
+        try:
+            if hasattr(chat_ids, '__aiter__'):
+                async for chat_id in chat_ids:
+                    self.queued += 1
+                    await queue.put(chat_id)
+            else:
+                for chat_id in chat_ids:
+                    self.queued += 1
+                    await queue.put(chat_id)
+            await queue.join()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            self._chat_next_send.clear()
+            self.running = False
+        return self.sent, self.failed
+
+
+# Ответы Telegram, после которых писать в чат бесполезно до нового /start
+DEAD_CHAT_ERRORS = ('chat not found', 'user is deactivated', 'bot was blocked', 'bot was kicked')
+
+
+def is_safe_to_retry(error):
+    """Ошибку отправки можно повторить, только если запрос точно не дошёл до Telegram.
+
+    Таймаут чтения (TimedOut) и обрыв после отправки не повторяются: сообщение
+    могло уже быть доставлено, повтор отправил бы его второй раз.
+    """
+    return isinstance(error.__cause__, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout))
+
+
+def classify_delivery_error(error):
+    """Статус получателя по результату отправки.
+
+    sent - доставлено, blocked - чат недоступен навсегда (бот заблокирован,
+    аккаунт удалён, чат не найден), failed - прочие ошибки.
+    """
+    if error is None:
+        return 'sent'
+    if isinstance(error, Forbidden):
+        return 'blocked'
+    message = str(error).lower()
+    if isinstance(error, BadRequest) and any(text in message for text in DEAD_CHAT_ERRORS):
+        return 'blocked'
+    return 'failed'
+
+
+class BroadcastDispatcher:
+    """Фоновая отправка рассылок, сохранённых в БД как задания.
+
+    Получатели забираются из broadcast_recipients порциями (queued -> sending),
+    результаты записываются пачками (sent/failed/blocked). Незавершённые
+    задания продолжаются при старте бота. Получатели, оставшиеся в sending
+    после падения, помечаются failed: доставка им неизвестна, а повторная
+    отправка могла бы продублировать сообщение.
+    """
+
+    def __init__(self, db, bucket, workers=10, per_chat_interval=1.0, batch_size=100,
+                 max_attempts=3, progress_interval=3):
+        self.db = db
+        self.bucket = bucket
+        self.workers = workers
+        self.per_chat_interval = per_chat_interval
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.progress_interval = progress_interval
+        self.engines = {}  # job_id -> BroadcastEngine активных рассылок
+        self._tasks = {}
+        self._notifications = set()
+        self._stopping = False
+
+    def start_job(self, bot, job):
+        task = asyncio.create_task(self._run_job(bot, job))
+        self._tasks[job.id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(job.id, None))
+
+    async def resume(self, bot):
+        """Продолжает рассылки, прерванные перезапуском"""
+        for job in await self.db.get_unfinished_broadcast_jobs():
+            interrupted = await self.db.fail_interrupted_recipients(job.id)
+            logging.info(f"Возобновление рассылки #{job.id} (прервано отправок: {interrupted})")
+            self.start_job(bot, job)
+
+    def notify(self, bot, messages):
+        """Фоновая отправка личных сообщений {chat_id: text} в общем лимите скорости рассылок"""
+        task = asyncio.create_task(self.send_notifications(bot, messages))
+        self._notifications.add(task)
+        task.add_done_callback(self._notifications.discard)
+
+    async def send_notifications(self, bot, messages):
+        """То же, что notify, но с ожиданием отправки; возвращает (sent, failed)"""
+        engine = BroadcastEngine(self.bucket, self.workers, self.per_chat_interval)
+
+        async def send(chat_id):
+            await self._send(bot, chat_id, messages[chat_id])
+
+        async def on_result(chat_id, error):
+            if error:
+                logging.warning(f"Уведомление для {chat_id} не доставлено: {error}")
+
+        sent, failed = await engine.run(list(messages), send, on_result)
+        logging.info(f"Уведомления отправлены: {sent}, ошибок: {failed}")
+        return sent, failed
+
+    async def stop(self, timeout=10):
+        """Перестаёт брать новых получателей и ждёт уже взятых; остаток продолжится после рестарта"""
+        self._stopping = True
+        tasks = list(self._tasks.values()) + list(self._notifications)
+        if tasks:
+            await asyncio.wait(tasks, timeout=timeout)
+
+    async def _send(self, bot, chat_id, text):
+        # Повторяем с паузой только ошибки соединения; остальные (в т.ч. TimedOut -
+        # доставка неизвестна) - окончательный failed, чтобы не отправить дважды
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                await bot.send_message(chat_id=chat_id, text=text)
+                return
+            except Exception as e:
+                if not is_safe_to_retry(e) or attempt == self.max_attempts:
+                    raise
+                await asyncio.sleep(2 ** attempt)
+
+    async def _report_progress(self, bot, job, engine):
+        while True:
+            await asyncio.sleep(self.progress_interval)
+            try:
+                await bot.edit_message_text(
+                    chat_id=job.progress_chat_id,
+                    message_id=job.progress_message_id,
+                    text=Messages.get_broadcast_progress_text(
+                        job.sent_count + engine.sent, job.total_count, job.failed_count + engine.failed
+                    )
+                )
+            except Exception as e:
+                logging.warning(f"Ошибка обновления прогресса рассылки #{job.id}: {e}")
+
+    async def _run_job(self, bot, job):
+        engine = BroadcastEngine(self.bucket, self.workers, self.per_chat_interval)
+        self.engines[job.id] = engine
+        results = []
+
+        async def flush():
+            nonlocal results
+            if results:
+                batch, results = results, []
+                await self.db.save_broadcast_results(job.id, batch)
+
+        async def on_result(chat_id, error):
+            status = classify_delivery_error(error)
+            metrics.BROADCAST_DELIVERIES.inc(status)
+            results.append((chat_id, status, str(error) if error else None))
+            if len(results) >= self.batch_size:
+                await flush()
+
+        async def recipients():
+            # Следующая порция забирается из БД, пока отправляется текущая
+            next_batch = asyncio.create_task(self.db.claim_broadcast_recipients(job.id, self.batch_size))
+            try:
+                while True:
+                    batch = await next_batch
+                    if not batch or self._stopping:
+                        break
+                    next_batch = asyncio.create_task(self.db.claim_broadcast_recipients(job.id, self.batch_size))
+                    for chat_id in batch:
+                        yield chat_id
+            finally:
+                # Забранная, но не начатая порция возвращается в очередь
+                unsent = await next_batch
+                if unsent:
+                    await self.db.release_broadcast_recipients(job.id, unsent)
+
+        async def send(chat_id):
+            await self._send(bot, chat_id, job.message_text)
+
+        progress_task = None
+        if job.progress_chat_id:
+            progress_task = asyncio.create_task(self._report_progress(bot, job, engine))
+        try:
+            await engine.run(recipients(), send, on_result)
+        finally:
+            if progress_task:
+                progress_task.cancel()
+            await flush()
+            self.engines.pop(job.id, None)
+
+        if self._stopping:
+            return
+
+        job = await self.db.finish_broadcast_job(job.id)
+        if not job:
+            return
+        logging.info(f"Рассылка #{job.id} завершена. Успешно: {job.sent_count}, Ошибок: {job.failed_count}")
+        if job.progress_chat_id:
+            try:
+                await bot.edit_message_text(
+                    chat_id=job.progress_chat_id,
+                    message_id=job.progress_message_id,
+                    text=Messages.get_broadcast_result_text(job.sent_count, job.failed_count, job.total_count)
+                )
+            except Exception as e:
+                logging.error(f"Ошибка отправки результата рассылки #{job.id}: {e}")
@@ -6,6 +6,37 @@ load_dotenv()
 class Config:
     BOT_TOKEN = os.getenv('BOT_TOKEN')
     ADMIN_ID = int(os.getenv('ADMIN_ID', 0))
+    DATABASE_URL = os.getenv('DATABASE_URL', 'sqlite+aiosqlite:///partner_bot.db')
+    # Адрес Bot API, по умолчанию https://api.telegram.org/bot (без токена в конце)
+    BOT_API_BASE_URL = os.getenv('BOT_API_BASE_URL')
+
+    # Режим webhook: если задан WEBHOOK_URL (публичный https-адрес), бот принимает апдейты
+    # по HTTP вместо long polling. WEBHOOK_SECRET обязателен - им проверяются входящие запросы
+    WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+    WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+    WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8443))
+    WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram')
+    WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+
+    # Сколько апдейтов обрабатывается одновременно (апдейты одного пользователя - по очереди)
+    CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', 64))
+
+    # Метрики в формате Prometheus: http://METRICS_HOST:METRICS_PORT/metrics (0 - выключено)
+    METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+    METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
+
+    # Профилирование SQL по апдейтам: число запросов и повторы одинаковых запросов (N+1) в логе
+    SQL_PROFILE = os.getenv('SQL_PROFILE', '').lower() in ('1', 'true', 'yes')
+    SQL_PROFILE_REPEAT_THRESHOLD = int(os.getenv('SQL_PROFILE_REPEAT_THRESHOLD', 3))
+    SQL_PROFILE_REPORT_EVERY = int(os.getenv('SQL_PROFILE_REPORT_EVERY', 500))  # апдейтов между сводками
+
+    # Групповая фиксация регистраций: записи за WRITE_BATCH_DELAY секунд - одной транзакцией
+    WRITE_BATCH_SIZE = int(os.getenv('WRITE_BATCH_SIZE', 0))  # Максимум записей в пачке, 0 - выключено
+    WRITE_BATCH_DELAY = float(os.getenv('WRITE_BATCH_DELAY', 0.01))
+
+    # Кэш партнёров в памяти процесса
+    USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 10000))
+    USER_CACHE_TTL = int(os.getenv('USER_CACHE_TTL', 300))  # секунды
 
     # Настройки сообщений
     WELCOME_MESSAGES = [
@@ -13,10 +44,34 @@ class Config:
         "Здесь ты можешь зарабатывать, привлекая клиентов в наш проект. Мы предлагаем одни из самых выгодных условий на рынке!",
         "Средний доход активных партнёров: от 15 до 85 тыс. рублей в месяц. Готов начать?"
     ]
+    # Приветственная серия отправляется фоновыми задачами JobQueue, по сообщению раз в N секунд
+    WELCOME_MESSAGE_INTERVAL = float(os.getenv('WELCOME_MESSAGE_INTERVAL', '1'))
+    WELCOME_RETRY_DELAY = 30  # Повтор при сетевой ошибке, секунд
 
     # Настройки реферальной системы
+    REFERRAL_SECRET = os.getenv('REFERRAL_SECRET')  # Ключ подписи реферальных ссылок
+    # Уведомления о новых рефералах копятся в БД и отправляются сводкой раз в N секунд
+    REFERRAL_DIGEST_INTERVAL = float(os.getenv('REFERRAL_DIGEST_INTERVAL', '60'))
+    REFERRAL_DIGEST_BATCH = 5000  # Уведомлений за один проход
     REFERRAL_BONUS = 500  # Бонус за привлечение
+    # Бонусы за подтверждённых партнёров 2-го, 3-го... уровня структуры (до 5-го), например "100,50"
+    REFERRAL_TIER_BONUSES = [int(bonus) for bonus in os.getenv('REFERRAL_TIER_BONUSES', '').split(',') if bonus.strip()]
     MIN_PAYOUT = 1000  # Минимальная сумма выплаты
 
-    # Настройки рассылок
-    BROADCAST_DELAY = 0.1  # Задержка между сообщениями (секунды)
\ No newline at end of file
+    # Очередь заявок в админ-панели
+    PAYOUTS_PAGE_SIZE = int(os.getenv('PAYOUTS_PAGE_SIZE', 5))  # Заявок на странице
+    PAYOUT_DETAILS_PREVIEW = 200  # Символов реквизитов в списке
+    BULK_APPROVE_MAX_AMOUNT = int(os.getenv('BULK_APPROVE_MAX_AMOUNT', 5000))  # Кнопка "Все до N руб."
+    PAYOUT_HISTORY_PAGE_SIZE = int(os.getenv('PAYOUT_HISTORY_PAGE_SIZE', 10))  # Заявок в истории партнёра
+
+    # Общая статистика админ-панели: снимок пересчитывается фоновой задачей
+    DASHBOARD_REFRESH_INTERVAL = int(os.getenv('DASHBOARD_REFRESH_INTERVAL', 300))  # Секунд между пересчётами
+    DASHBOARD_HISTORY_DAYS = 7  # Дней истории на экране статистики
+
+    # Настройки рассылок (лимиты Telegram: ~30 сообщений/с всего, ~1 сообщение/с в один чат)
+    BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', 25))  # Сообщений в секунду
+    BROADCAST_WORKERS = int(os.getenv('BROADCAST_WORKERS', 10))
+    BROADCAST_PER_CHAT_INTERVAL = 1.0  # Секунд между сообщениями в один чат
+    BROADCAST_PROGRESS_INTERVAL = 3  # Как часто обновлять прогресс у админа (секунды)
+    BROADCAST_BATCH_SIZE = 100  # Получателей за одно обращение к БД
+    BROADCAST_MAX_ATTEMPTS = 3  # Попыток при временных сетевых ошибках
\ No newline at end of file
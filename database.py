@@ -1,9 +1,16 @@
-from sqlalchemy import create_engine, Column, Integer, String, Boolean, DateTime, Text, Float
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, Text, Float, Index
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy import select, func
-from datetime import datetime
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy import select, func, event, case, literal, union_all, delete, update, bindparam, and_, or_, true, exists, tuple_
+from sqlalchemy.dialects import sqlite, postgresql
+from migrations import upgrade
+from cache import TTLCache
+from write_batcher import WriteBatcher
+from referral_tokens import make_referral_token, parse_referral_token
+from datetime import datetime, timedelta
 import secrets
+from array import array
+from collections import defaultdict
 import logging
 
 Base = declarative_base()
@@ -17,12 +24,22 @@ class User(Base):
     first_name = Column(String(100))
     last_name = Column(String(100))
     referral_link = Column(String(50), unique=True)
-    signed_agreement = Column(Boolean, default=False)
-    signed_at = Column(DateTime)
-    created_at = Column(DateTime, default=datetime.now)
+    signed_agreement = Column(Boolean, default=False, index=True)
+    signed_at = Column(DateTime, index=True)
+    created_at = Column(DateTime, default=datetime.now, index=True)
+    # Бот заблокирован или чат недоступен: пользователь исключается из рассылок до нового /start
+    blocked_at = Column(DateTime)
+    last_delivery_error = Column(Text)
 
 class Referral(Base):
     __tablename__ = 'referrals'
+    __table_args__ = (
+        # Одна связь реферер -> приглашённый; покрывает и COUNT по referrer_id
+        Index('uq_referrals_referrer_referred', 'referrer_id', 'referred_id', unique=True),
+        Index('ix_referrals_referrer_confirmed', 'referrer_id', 'confirmed'),
+        Index('ix_referrals_referred_id', 'referred_id'),
+        Index('ix_referrals_confirmed_at', 'confirmed_at'),
+    )
 
     id = Column(Integer, primary_key=True)
     referrer_id = Column(Integer, nullable=False)
@@ -33,6 +50,13 @@ class Referral(Base):
 
 class Payout(Base):
     __tablename__ = 'payouts'
+    __table_args__ = (
+        Index('ix_payouts_user_status', 'user_id', 'status'),
+        Index('ix_payouts_status_requested', 'status', 'requested_at'),
+        Index('ix_payouts_user_requested', 'user_id', 'requested_at'),
+        Index('ix_payouts_requested_at', 'requested_at'),
+        Index('ix_payouts_processed_at', 'processed_at'),
+    )
 
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, nullable=False)
@@ -52,55 +76,619 @@ class AdminMessage(Base):
     sent_by = Column(Integer, nullable=False)
     recipients_count = Column(Integer, default=0)
 
+class BroadcastJob(Base):
+    """Рассылка как задание: переживает перезапуск бота и продолжается с места остановки"""
+    __tablename__ = 'broadcast_jobs'
+
+    id = Column(Integer, primary_key=True)
+    message_text = Column(Text, nullable=False)
+    audience = Column(String(20), default='all')  # all, signed, unsigned
+    status = Column(String(20), default='running', index=True)  # running, done
+    created_by = Column(Integer, nullable=False)
+    created_at = Column(DateTime, default=datetime.now)
+    finished_at = Column(DateTime)
+    total_count = Column(Integer, default=0)
+    sent_count = Column(Integer, default=0)
+    failed_count = Column(Integer, default=0)
+    # Сообщение админа, в котором показывается прогресс
+    progress_chat_id = Column(Integer)
+    progress_message_id = Column(Integer)
+
+class BroadcastRecipient(Base):
+    __tablename__ = 'broadcast_recipients'
+    __table_args__ = (
+        Index('ix_broadcast_recipients_job_status', 'job_id', 'status', 'user_id'),
+    )
+
+    job_id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, primary_key=True)
+    # queued -> sending -> sent / failed / blocked
+    status = Column(String(20), default='queued', nullable=False)
+    error = Column(Text)
+    updated_at = Column(DateTime)
+
+class ScheduledMessage(Base):
+    """Отложенное личное сообщение (приветственная серия): хранится до отправки и переживает перезапуск"""
+    __tablename__ = 'scheduled_messages'
+
+    id = Column(Integer, primary_key=True)
+    chat_id = Column(Integer, nullable=False)
+    text = Column(Text, nullable=False)
+    reply_markup = Column(Text, nullable=True)  # JSON клавиатуры (InlineKeyboardMarkup.to_json)
+    send_at = Column(DateTime, nullable=False, index=True)
+    created_at = Column(DateTime, default=datetime.now)
+
+class ReferralNotification(Base):
+    """Исходящие уведомления рефереру о новых партнёрах; отправляются сводкой фоновой задачей"""
+    __tablename__ = 'referral_notifications'
+
+    id = Column(Integer, primary_key=True)
+    referrer_id = Column(Integer, nullable=False)
+    referred_name = Column(String(100))
+    created_at = Column(DateTime, default=datetime.now)
+
+class PartnerStats(Base):
+    """Счётчики партнёра, обновляются в тех же транзакциях, что и referrals/payouts"""
+    __tablename__ = 'partner_stats'
+
+    user_id = Column(Integer, primary_key=True)
+    total_referrals = Column(Integer, default=0, nullable=False)
+    confirmed_referrals = Column(Integer, default=0, nullable=False)
+    pending_payouts = Column(Float, default=0, nullable=False)
+    paid_payouts = Column(Float, default=0, nullable=False)
+
+class ReferralPath(Base):
+    """Замыкание дерева рефералов: пара предок -> потомок для каждого уровня до REFERRAL_TREE_DEPTH"""
+    __tablename__ = 'referral_paths'
+    __table_args__ = (
+        Index('ix_referral_paths_descendant', 'descendant_id', 'depth'),
+    )
+
+    ancestor_id = Column(Integer, primary_key=True)
+    descendant_id = Column(Integer, primary_key=True)
+    depth = Column(Integer, nullable=False)  # 1 - прямой реферал
+
+class DownlineStats(Base):
+    """Размер структуры партнёра по уровням, обновляется в тех же транзакциях, что и referral_paths"""
+    __tablename__ = 'downline_stats'
+
+    user_id = Column(Integer, primary_key=True)
+    depth = Column(Integer, primary_key=True)
+    total_referrals = Column(Integer, default=0, nullable=False)
+    confirmed_referrals = Column(Integer, default=0, nullable=False)
+
+class DashboardSnapshot(Base):
+    """Итоги для админ-панели (одна строка id=1), пересчитываются фоновой задачей"""
+    __tablename__ = 'dashboard_snapshot'
+
+    id = Column(Integer, primary_key=True)
+    total_users = Column(Integer, default=0, nullable=False)
+    signed_users = Column(Integer, default=0, nullable=False)
+    blocked_users = Column(Integer, default=0, nullable=False)
+    total_referrals = Column(Integer, default=0, nullable=False)
+    confirmed_referrals = Column(Integer, default=0, nullable=False)
+    pending_payouts = Column(Float, default=0, nullable=False)
+    paid_payouts = Column(Float, default=0, nullable=False)
+    refreshed_at = Column(DateTime)
+
+class DailyStats(Base):
+    """История по дням для админ-панели, пересчитывается вместе с dashboard_snapshot"""
+    __tablename__ = 'daily_stats'
+
+    day = Column(String(10), primary_key=True)  # YYYY-MM-DD
+    signups = Column(Integer, default=0, nullable=False)
+    signed = Column(Integer, default=0, nullable=False)
+    confirmed_referrals = Column(Integer, default=0, nullable=False)
+    payouts_requested = Column(Float, default=0, nullable=False)
+    payouts_paid = Column(Float, default=0, nullable=False)
+
+def _empty_dashboard():
+    return DashboardSnapshot(
+        id=1, total_users=0, signed_users=0, blocked_users=0, total_referrals=0,
+        confirmed_referrals=0, pending_payouts=0, paid_payouts=0, refreshed_at=None
+    )
+
+# Статусы выплат, которые списываются с баланса
+PAID_STATUSES = ('approved', 'paid')
+
+# Сколько уровней структуры хранится в referral_paths
+REFERRAL_TREE_DEPTH = 5
+
+def _payout_bucket(status):
+    if status == 'pending':
+        return 'pending_payouts'
+    if status in PAID_STATUSES:
+        return 'paid_payouts'
+    return None
+
+def _dialect_insert(session, table):
+    """INSERT с поддержкой ON CONFLICT для текущей СУБД (AsyncSession или синхронное соединение)"""
+    dialect = session.dialect if hasattr(session, 'dialect') else session.bind.dialect
+    if dialect.name == 'postgresql':
+        return postgresql.insert(table)
+    return sqlite.insert(table)
+
+async def _bump_stats(session, user_id, **deltas):
+    """Атомарно прибавляет deltas к счётчикам партнёра (строка создаётся при первом обращении)"""
+    stmt = _dialect_insert(session, PartnerStats).values(user_id=user_id, **deltas)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[PartnerStats.user_id],
+        set_={name: getattr(PartnerStats, name) + value for name, value in deltas.items()}
+    )
+    await session.execute(stmt)
+
+def _referral_paths_insert():
+    """INSERT путей от предков реферера (и его самого) к потомкам приглашённого (и к нему самому).
+
+    Строится один раз с параметрами :referrer_id/:referred_id - построение такого
+    выражения заметно дороже самого запроса. Пропускается, если приглашённый уже
+    в дереве или он предок реферера (цикл).
+    """
+    referrer_id = bindparam('referrer_id', type_=Integer)
+    referred_id = bindparam('referred_id', type_=Integer)
+    ancestors = union_all(
+        select(referrer_id.label('ancestor_id'), literal(0).label('depth')),
+        select(ReferralPath.ancestor_id, ReferralPath.depth).where(ReferralPath.descendant_id == referrer_id)
+    ).subquery()
+    descendants = union_all(
+        select(referred_id.label('descendant_id'), literal(0).label('depth')),
+        select(ReferralPath.descendant_id, ReferralPath.depth).where(ReferralPath.ancestor_id == referred_id)
+    ).subquery()
+    already_linked = exists().where(or_(
+        ReferralPath.descendant_id == referred_id,
+        and_(ReferralPath.ancestor_id == referred_id, ReferralPath.descendant_id == referrer_id)
+    ))
+    depth = ancestors.c.depth + descendants.c.depth + 1
+    paths = ReferralPath.__table__
+    return (
+        paths.insert()
+        .from_select(
+            ['ancestor_id', 'descendant_id', 'depth'],
+            select(ancestors.c.ancestor_id, descendants.c.descendant_id, depth)
+            .select_from(ancestors.join(descendants, true()))
+            .where(depth <= REFERRAL_TREE_DEPTH, ~already_linked)
+        )
+        .returning(paths.c.ancestor_id, paths.c.descendant_id, paths.c.depth)
+    )
+
+_REFERRAL_PATHS_INSERT = _referral_paths_insert()
+
+async def _link_referral_tree(session, referrer_id, referred_id):
+    """Добавляет referred_id вместе с его структурой в дерево под referrer_id.
+
+    В дереве учитывается только первый реферер пользователя, связи с циклом не
+    добавляются. downline_stats увеличивается по фактически вставленным путям.
+    """
+    if referrer_id == referred_id:
+        return
+    rows = (await session.execute(
+        _REFERRAL_PATHS_INSERT, {'referrer_id': referrer_id, 'referred_id': referred_id}
+    )).all()
+    if not rows:
+        return
+
+    # Подтверждённым может быть и сам referred_id: add_referral привязывает и тех, кто
+    # уже был подтверждён по записи, не попавшей в дерево (связь с циклом)
+    moved = {descendant_id for _, descendant_id, _ in rows}
+    confirmed = set(await session.scalars(
+        select(Referral.referred_id).where(Referral.referred_id.in_(moved), Referral.confirmed == True)
+    ))
+    counters = defaultdict(lambda: [0, 0])
+    for ancestor_id, descendant_id, path_depth in rows:
+        counter = counters[(ancestor_id, path_depth)]
+        counter[0] += 1
+        counter[1] += descendant_id in confirmed
+    # Простой upsert с executemany: ON CONFLICT DO UPDATE не кэшируется SQLAlchemy,
+    # поэтому сложный INSERT ... SELECT компилировался бы на каждый вызов
+    stmt = _dialect_insert(session, DownlineStats)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[DownlineStats.user_id, DownlineStats.depth],
+        set_={
+            'total_referrals': DownlineStats.total_referrals + stmt.excluded.total_referrals,
+            'confirmed_referrals': DownlineStats.confirmed_referrals + stmt.excluded.confirmed_referrals
+        }
+    )
+    await session.execute(stmt, [
+        {'user_id': user_id, 'depth': path_depth, 'total_referrals': total, 'confirmed_referrals': confirmed_count}
+        for (user_id, path_depth), (total, confirmed_count) in counters.items()
+    ])
+
+async def _bump_downline_confirmed(session, referred_id):
+    """+1 подтверждённый на своём уровне у всех предков referred_id.
+
+    Строки downline_stats для этих путей уже созданы _link_referral_tree, поэтому
+    достаточно UPDATE (в отличие от ON CONFLICT он кэшируется SQLAlchemy).
+    """
+    await session.execute(
+        update(DownlineStats)
+        .where(tuple_(DownlineStats.user_id, DownlineStats.depth).in_(
+            select(ReferralPath.ancestor_id, ReferralPath.depth).where(ReferralPath.descendant_id == referred_id)
+        ))
+        .values(confirmed_referrals=DownlineStats.confirmed_referrals + 1)
+        .execution_options(synchronize_session=False)
+    )
+
+def rebuild_partner_stats(connection):
+    """Пересчёт partner_stats из referrals и payouts (синхронное соединение, run_sync)"""
+    zero = literal(0)
+    rows = union_all(
+        select(
+            Referral.referrer_id.label('user_id'),
+            literal(1).label('total_referrals'),
+            case((Referral.confirmed == True, 1), else_=0).label('confirmed_referrals'),
+            zero.label('pending_payouts'),
+            zero.label('paid_payouts')
+        ),
+        select(
+            Payout.user_id,
+            zero,
+            zero,
+            case((Payout.status == 'pending', Payout.amount), else_=0),
+            case((Payout.status.in_(PAID_STATUSES), Payout.amount), else_=0)
+        )
+    ).subquery()
+    connection.execute(delete(PartnerStats))
+    connection.execute(PartnerStats.__table__.insert().from_select(
+        ['user_id', 'total_referrals', 'confirmed_referrals', 'pending_payouts', 'paid_payouts'],
+        select(
+            rows.c.user_id,
+            func.sum(rows.c.total_referrals),
+            func.sum(rows.c.confirmed_referrals),
+            func.sum(rows.c.pending_payouts),
+            func.sum(rows.c.paid_payouts)
+        ).group_by(rows.c.user_id)
+    ))
+
+def _relink_cyclic_referrals(connection, first_referrals):
+    """Родители для пользователей, к которым реферер мог привязаться с циклом.
+
+    Цикл возможен, только если у приглашённого уже были свои рефералы: такие
+    записи проверяются по одной в порядке id, как в _link_referral_tree, -
+    связь пропускается, если приглашённый среди предков реферера.
+    """
+    first = Referral.__table__.alias('first')
+    outgoing = Referral.__table__.alias('outgoing')
+    suspects = (
+        select(first.c.referred_id)
+        .join(outgoing, and_(outgoing.c.referrer_id == first.c.referred_id, outgoing.c.id < first.c.id,
+                             outgoing.c.referred_id != outgoing.c.referrer_id))
+        .where(first.c.id.in_(first_referrals))
+    )
+    candidates = connection.execute(
+        select(Referral.id, Referral.referrer_id, Referral.referred_id)
+        .where(Referral.referred_id.in_(suspects), Referral.referrer_id != Referral.referred_id)
+        .order_by(Referral.id)
+    ).all()
+    if not candidates:
+        return
+
+    suspect_ids = {referred_id for _, _, referred_id in candidates}
+    accepted = {}
+    first_parents = {}
+
+    def parent_at(user_id, referral_id):
+        # Родитель user_id на момент записи referral_id
+        if user_id in suspect_ids:
+            link = accepted.get(user_id)
+        else:
+            if user_id not in first_parents:
+                first_parents[user_id] = connection.execute(
+                    select(Referral.referrer_id, Referral.id)
+                    .where(Referral.referred_id == user_id, Referral.referrer_id != Referral.referred_id)
+                    .order_by(Referral.id).limit(1)
+                ).first()
+            link = first_parents[user_id]
+        return link[0] if link and link[1] < referral_id else None
+
+    for referral_id, referrer_id, referred_id in candidates:
+        if referred_id in accepted:
+            continue
+        # Путь referred -> referrer хранится только до REFERRAL_TREE_DEPTH уровней
+        ancestor = referrer_id
+        for _ in range(REFERRAL_TREE_DEPTH):
+            ancestor = parent_at(ancestor, referral_id)
+            if ancestor is None or ancestor == referred_id:
+                break
+        if ancestor != referred_id:
+            accepted[referred_id] = (referrer_id, referral_id)
+
+    connection.execute(delete(ReferralPath).where(ReferralPath.descendant_id.in_(suspects)))
+    if accepted:
+        connection.execute(ReferralPath.__table__.insert(), [
+            {'ancestor_id': referrer_id, 'descendant_id': referred_id, 'depth': 1}
+            for referred_id, (referrer_id, _) in accepted.items()
+        ])
+
+def rebuild_referral_tree(connection):
+    """Пересчёт referral_paths и downline_stats из referrals (синхронное соединение, run_sync).
+
+    Повторяет правила _link_referral_tree в порядке id: родитель пользователя -
+    реферер из первой записи, которая не замыкает цикл. Без цикла это просто
+    самая ранняя запись; проход по одной записи нужен только пользователям,
+    у которых свои рефералы появились раньше их первого реферера.
+    """
+    paths = ReferralPath.__table__
+    connection.execute(delete(DownlineStats))
+    connection.execute(delete(ReferralPath))
+    not_self = Referral.referrer_id != Referral.referred_id
+    first_referrals = select(func.min(Referral.id)).where(not_self).group_by(Referral.referred_id)
+    connection.execute(paths.insert().from_select(
+        ['ancestor_id', 'descendant_id', 'depth'],
+        select(Referral.referrer_id, Referral.referred_id, literal(1)).where(Referral.id.in_(first_referrals))
+    ))
+    _relink_cyclic_referrals(connection, first_referrals)
+    parent = ReferralPath.__table__.alias('parent')
+    for depth in range(2, REFERRAL_TREE_DEPTH + 1):
+        # Циклы из старых данных: путь в себя пропускается, повтор пары - ON CONFLICT DO NOTHING
+        connection.execute(_dialect_insert(connection, ReferralPath).from_select(
+            ['ancestor_id', 'descendant_id', 'depth'],
+            select(paths.c.ancestor_id, parent.c.descendant_id, literal(depth))
+            .join(parent, and_(parent.c.ancestor_id == paths.c.descendant_id, parent.c.depth == 1))
+            .where(paths.c.depth == depth - 1, paths.c.ancestor_id != parent.c.descendant_id)
+        ).on_conflict_do_nothing())
+    confirmed_users = select(Referral.referred_id).where(Referral.confirmed == True).distinct().subquery()
+    connection.execute(DownlineStats.__table__.insert().from_select(
+        ['user_id', 'depth', 'total_referrals', 'confirmed_referrals'],
+        select(
+            paths.c.ancestor_id,
+            paths.c.depth,
+            func.count(),
+            func.count(confirmed_users.c.referred_id)
+        )
+        .select_from(paths.outerjoin(confirmed_users, confirmed_users.c.referred_id == paths.c.descendant_id))
+        .group_by(paths.c.ancestor_id, paths.c.depth)
+    ))
+
+def _payout_keyset(stmt, after_id=None, before_id=None, newest_first=False):
+    """Условие и порядок keyset-пагинации заявок по (requested_at, id).
+
+    Страница before_id выбирается в обратном порядке - вызывающий разворачивает её.
+    """
+    cursor_id = before_id if before_id is not None else after_id
+    ascending = (before_id is None) != newest_first
+    if cursor_id is not None:
+        cursor_at = select(Payout.requested_at).where(Payout.id == cursor_id).scalar_subquery()
+        if ascending:
+            stmt = stmt.where(Payout.requested_at >= cursor_at,
+                              or_(Payout.requested_at > cursor_at, Payout.id > cursor_id))
+        else:
+            stmt = stmt.where(Payout.requested_at <= cursor_at,
+                              or_(Payout.requested_at < cursor_at, Payout.id < cursor_id))
+    if ascending:
+        return stmt.order_by(Payout.requested_at, Payout.id)
+    return stmt.order_by(Payout.requested_at.desc(), Payout.id.desc())
+
+def _audience_condition(audience, include_blocked=False):
+    condition = True if include_blocked else User.blocked_at.is_(None)
+    if audience == 'signed':
+        return and_(condition, User.signed_agreement == True)
+    if audience == 'unsigned':
+        return and_(condition, User.signed_agreement == False)
+    return condition
+
+def _configure_sqlite(dbapi_connection, connection_record):
+    """WAL позволяет читать параллельно с записью, busy_timeout - ждать блокировку вместо ошибки"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.close()
+
 class Database:
-    def __init__(self, db_url='sqlite:///partner_bot.db'):
-        self.engine = create_engine(db_url)
-        Base.metadata.create_all(self.engine)
-        Session = sessionmaker(bind=self.engine)
-        self.session = Session()
+    def __init__(self, db_url='sqlite+aiosqlite:///partner_bot.db', cache_size=10000, cache_ttl=300,
+                 write_batch_size=0, write_batch_delay=0.01, referral_secret=None):
+        self.engine = create_async_engine(db_url)
+        if self.engine.dialect.name == 'sqlite':
+            event.listen(self.engine.sync_engine, 'connect', _configure_sqlite)
+        # Каждая операция берёт свою короткую сессию из пула соединений,
+        # поэтому параллельные обработчики не делят одну сессию.
+        # expire_on_commit=False: объекты остаются читаемыми после commit без повторного SELECT
+        self.Session = async_sessionmaker(bind=self.engine, expire_on_commit=False)
+        # Кэш партнёров: user_id -> User и referral_link -> user_id.
+        # Записи пользователя меняются только через create_user/sign_agreement,
+        # которые обновляют кэш сразу после commit.
+        self.user_cache = TTLCache(cache_size, cache_ttl)
+        self.link_cache = TTLCache(cache_size, cache_ttl)
+        # Ключ подписи реферальных ссылок; без него новые ссылки - старого вида ref_<id>_<hex>
+        self.referral_secret = referral_secret
+        # Групповая фиксация create_user/sign_agreement/add_referral/confirm_referral
+        # (write_batch_size > 1): одна транзакция на все записи за write_batch_delay секунд
+        self.write_batcher = None
+        if write_batch_size > 1:
+            self.write_batcher = WriteBatcher(self.Session, write_batch_size, write_batch_delay)
+
+    def _cache_user(self, user):
+        self.user_cache.set(user.user_id, user)
+        if user.referral_link:
+            self.link_cache.set(user.referral_link, user.user_id)
+
+    def invalidate_user(self, user_id):
+        self.user_cache.invalidate(user_id)
+
+    async def init(self):
+        """Создание недостающих таблиц и миграция существующей схемы. Вызывается при старте приложения"""
+        async with self.engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+            await conn.run_sync(upgrade)
 
-    def get_user(self, user_id):
+    async def close(self):
+        if self.write_batcher:
+            await self.write_batcher.close()
+        await self.engine.dispose()
+
+    async def get_user(self, user_id):
+        user = self.user_cache.get(user_id)
+        if user is not None:
+            return user
         try:
-            stmt = select(User).where(User.user_id == user_id)
-            return self.session.scalar(stmt)
+            async with self.Session() as session:
+                stmt = select(User).where(User.user_id == user_id)
+                user = await session.scalar(stmt)
+            if user:
+                self._cache_user(user)
+            return user
         except Exception as e:
             logging.error(f"Error getting user {user_id}: {e}")
             return None
 
-    def create_user(self, user_data):
-        try:
+    async def _write(self, op):
+        """Выполняет await op(session) и фиксирует транзакцию.
+
+        С включённой групповой фиксацией операция попадает в общую пачку
+        WriteBatcher; результат возвращается после COMMIT в обоих случаях.
+        """
+        if self.write_batcher:
+            return await self.write_batcher.submit(op)
+        async with self.Session() as session:
+            result = await op(session)
+            await session.commit()
+        return result
+
+    def _new_referral_link(self, user_id):
+        if self.referral_secret:
+            return make_referral_token(user_id, self.referral_secret)
+        return f"ref_{user_id}_{secrets.token_hex(8)}"
+
+    async def resolve_referrer_id(self, referral_link):
+        """user_id владельца реферальной ссылки или None.
+
+        Подписанные ссылки проверяются в памяти; старые ref_... и подписанные ключом,
+        который с тех пор сменился (новый REFERRAL_SECRET или токен бота), ищутся в БД
+        (с кэшем) - каждая выданная ссылка хранится в users.referral_link.
+        """
+        if self.referral_secret:
+            referrer_id = parse_referral_token(referral_link, self.referral_secret)
+            if referrer_id is not None:
+                return referrer_id
+        ref_owner = await self.get_user_by_referral_link(referral_link)
+        return ref_owner.user_id if ref_owner else None
+
+    async def create_user(self, user_data):
+        async def op(session):
             user = User(
                 user_id=user_data.id,
                 username=user_data.username,
                 first_name=user_data.first_name,
                 last_name=user_data.last_name,
-                referral_link=f"ref_{user_data.id}_{secrets.token_hex(8)}"
+                referral_link=self._new_referral_link(user_data.id)
             )
-            self.session.add(user)
-            self.session.commit()
+            session.add(user)
+            await session.flush()
+            return user
+
+        try:
+            user = await self._write(op)
+            self._cache_user(user)
             return user
         except Exception as e:
             logging.error(f"Error creating user: {e}")
-            self.session.rollback()
+            self.invalidate_user(user_data.id)
             return None
 
-    def sign_agreement(self, user_id):
+    async def onboard_user(self, user_data, referrer_id=None, welcome_messages=(), welcome_interval=1.0):
+        """Регистрация из /start одной транзакцией, безопасная при параллельных /start.
+
+        Пользователь вставляется через INSERT ... ON CONFLICT DO NOTHING; если его
+        создал этот вызов, в той же транзакции вставляется реферал (с увеличением
+        счётчика реферера и уведомлением в referral_notifications) и ставятся
+        в очередь welcome_messages - пары (текст, JSON клавиатуры или None), по одной
+        каждые welcome_interval секунд. Возвращает (user, created, referral_created, scheduled).
+        """
+        async def op(session):
+            stmt = (
+                _dialect_insert(session, User)
+                .values(
+                    user_id=user_data.id,
+                    username=user_data.username,
+                    first_name=user_data.first_name,
+                    last_name=user_data.last_name,
+                    referral_link=self._new_referral_link(user_data.id)
+                )
+                .on_conflict_do_nothing(index_elements=[User.user_id])
+                .returning(User)
+            )
+            user = (await session.scalars(stmt)).first()
+            if user is None:
+                # Пользователь уже есть (параллельный /start) - реферал не засчитываем
+                return await session.scalar(select(User).where(User.user_id == user_data.id)), False, False, []
+
+            referral_created = False
+            if referrer_id and referrer_id != user_data.id:
+                inserted = await session.scalar(
+                    _dialect_insert(session, Referral)
+                    .values(referrer_id=referrer_id, referred_id=user_data.id)
+                    .on_conflict_do_nothing(index_elements=[Referral.referrer_id, Referral.referred_id])
+                    .returning(Referral.id)
+                )
+                if inserted:
+                    await _bump_stats(session, referrer_id, total_referrals=1)
+                    await _link_referral_tree(session, referrer_id, user_data.id)
+                    session.add(ReferralNotification(referrer_id=referrer_id, referred_name=user_data.first_name))
+                    referral_created = True
+
+            now = datetime.now()
+            scheduled = [
+                ScheduledMessage(
+                    chat_id=user_data.id, text=text, reply_markup=reply_markup,
+                    send_at=now + timedelta(seconds=welcome_interval * (i + 1))
+                )
+                for i, (text, reply_markup) in enumerate(welcome_messages)
+            ]
+            if scheduled:
+                session.add_all(scheduled)
+                await session.flush()
+            return user, True, referral_created, scheduled
+
         try:
-            user = self.get_user(user_id)
+            user, created, referral_created, scheduled = await self._write(op)
+            if user:
+                self._cache_user(user)
+            return user, created, referral_created, scheduled
+        except Exception as e:
+            logging.error(f"Error onboarding user {user_data.id}: {e}")
+            self.invalidate_user(user_data.id)
+            return None, False, False, []
+
+    async def sign_agreement(self, user_id):
+        async def op(session):
+            user = await session.scalar(select(User).where(User.user_id == user_id))
             if user:
                 user.signed_agreement = True
                 user.signed_at = datetime.now()
-                self.session.commit()
+                await session.flush()
+            return user
+
+        try:
+            user = await self._write(op)
+            if user:
+                self._cache_user(user)
             return user
         except Exception as e:
             logging.error(f"Error signing agreement for {user_id}: {e}")
-            self.session.rollback()
+            self.invalidate_user(user_id)
             return None
 
-    def add_referral(self, referrer_id, referred_id):
+    async def mark_user_reachable(self, user_id):
+        """Снимает blocked_at: пользователь снова написал боту и вернётся в рассылки"""
         try:
+            async with self.Session() as session:
+                user = await session.scalar(select(User).where(User.user_id == user_id))
+                if user:
+                    user.blocked_at = None
+                    user.last_delivery_error = None
+                    await session.commit()
+            if user:
+                self._cache_user(user)
+            return user
+        except Exception as e:
+            logging.error(f"Error marking user {user_id} reachable: {e}")
+            self.invalidate_user(user_id)
+            return None
+
+    async def add_referral(self, referrer_id, referred_id):
+        async def op(session):
             # Проверяем, нет ли уже такой записи
-            existing = self.session.scalar(
+            existing = await session.scalar(
                 select(Referral).where(
                     Referral.referrer_id == referrer_id,
                     Referral.referred_id == referred_id
@@ -110,58 +698,71 @@ class Database:
                 return existing
 
             referral = Referral(referrer_id=referrer_id, referred_id=referred_id)
-            self.session.add(referral)
-            self.session.commit()
+            session.add(referral)
+            await _bump_stats(session, referrer_id, total_referrals=1)
+            await _link_referral_tree(session, referrer_id, referred_id)
+            await session.flush()
             return referral
+
+        try:
+            return await self._write(op)
         except Exception as e:
             logging.error(f"Error adding referral: {e}")
-            self.session.rollback()
             return None
 
-    def confirm_referral(self, referred_id):
-        try:
+    async def confirm_referral(self, referred_id):
+        async def op(session):
             stmt = select(Referral).where(Referral.referred_id == referred_id)
-            referral = self.session.scalar(stmt)
-            if referral:
+            referral = await session.scalar(stmt)
+            if referral and not referral.confirmed:
                 referral.confirmed = True
                 referral.confirmed_at = datetime.now()
-                self.session.commit()
+                await _bump_stats(session, referral.referrer_id, confirmed_referrals=1)
+                await _bump_downline_confirmed(session, referred_id)
+                await session.flush()
             return referral
+
+        try:
+            return await self._write(op)
         except Exception as e:
             logging.error(f"Error confirming referral {referred_id}: {e}")
-            self.session.rollback()
             return None
 
-    def get_user_stats(self, user_id):
+    async def get_referrals_by_referred(self, referred_id):
         try:
-            # Всего рефералов
-            total_stmt = select(func.count(Referral.id)).where(Referral.referrer_id == user_id)
-            total_referrals = self.session.scalar(total_stmt) or 0
-
-            # Подтвержденные рефералы
-            confirmed_stmt = select(func.count(Referral.id)).where(
-                Referral.referrer_id == user_id,
-                Referral.confirmed == True
-            )
-            confirmed_referrals = self.session.scalar(confirmed_stmt) or 0
+            async with self.Session() as session:
+                stmt = select(Referral).where(Referral.referred_id == referred_id)
+                return list(await session.scalars(stmt))
+        except Exception as e:
+            logging.error(f"Error getting referrals for {referred_id}: {e}")
+            return []
 
-            # Расчет дохода
-            from config import Config
-            total_income = confirmed_referrals * Config.REFERRAL_BONUS
+    async def get_user_stats(self, user_id):
+        """Счётчики и баланс партнёра одним запросом: partner_stats и downline_stats 2+ уровней"""
+        from config import Config
+        try:
+            async with self.Session() as session:
+                # Уровни 2+ есть только у партнёров с прямыми рефералами, т.е. со строкой partner_stats
+                rows = (await session.execute(
+                    select(PartnerStats, DownlineStats)
+                    .outerjoin(DownlineStats, and_(DownlineStats.user_id == PartnerStats.user_id, DownlineStats.depth > 1))
+                    .where(PartnerStats.user_id == user_id)
+                    .order_by(DownlineStats.depth)
+                )).all()
+            partner_stats = rows[0][0] if rows else None
+            levels = [level for _, level in rows if level is not None]
 
-            # Ожидающие выплаты
-            pending_payouts_stmt = select(func.sum(Payout.amount)).where(
-                Payout.user_id == user_id,
-                Payout.status == 'pending'
-            )
-            pending_payouts = self.session.scalar(pending_payouts_stmt) or 0
+            total_referrals = partner_stats.total_referrals if partner_stats else 0
+            confirmed_referrals = partner_stats.confirmed_referrals if partner_stats else 0
+            pending_payouts = (partner_stats.pending_payouts if partner_stats else 0) or 0
+            paid_payouts = (partner_stats.paid_payouts if partner_stats else 0) or 0
 
-            # Выплаченные средства
-            paid_payouts_stmt = select(func.sum(Payout.amount)).where(
-                Payout.user_id == user_id,
-                Payout.status.in_(['approved', 'paid'])
-            )
-            paid_payouts = self.session.scalar(paid_payouts_stmt) or 0
+            # Расчет дохода: бонус за прямых рефералов и REFERRAL_TIER_BONUSES за 2-й, 3-й... уровни
+            total_income = confirmed_referrals * Config.REFERRAL_BONUS
+            tiers = Config.REFERRAL_TIER_BONUSES
+            for level in levels:
+                if level.depth - 2 < len(tiers):
+                    total_income += level.confirmed_referrals * tiers[level.depth - 2]
 
             # Доступно для вывода
             available_balance = total_income - paid_payouts - pending_payouts
@@ -174,86 +775,574 @@ class Database:
                 'total_income': total_income,
                 'available_balance': max(available_balance, 0),
                 'pending_payouts': pending_payouts,
-                'paid_payouts': paid_payouts
+                'paid_payouts': paid_payouts,
+                # Структура глубже прямых рефералов: [(уровень, всего, подтверждено)]
+                'levels': [(level.depth, level.total_referrals, level.confirmed_referrals) for level in levels]
             }
         except Exception as e:
             logging.error(f"Error getting stats for {user_id}: {e}")
-            return {'total': 0, 'confirmed': 0, 'active': 0, 'pending': 0, 'total_income': 0, 'available_balance': 0, 'pending_payouts': 0, 'paid_payouts': 0}
+            return {'total': 0, 'confirmed': 0, 'active': 0, 'pending': 0, 'total_income': 0, 'available_balance': 0, 'pending_payouts': 0, 'paid_payouts': 0, 'levels': []}
 
-    def get_user_by_referral_link(self, referral_link):
+    async def get_user_by_referral_link(self, referral_link):
+        user_id = self.link_cache.get(referral_link)
+        if user_id is not None:
+            return await self.get_user(user_id)
         try:
-            stmt = select(User).where(User.referral_link == referral_link)
-            return self.session.scalar(stmt)
+            async with self.Session() as session:
+                stmt = select(User).where(User.referral_link == referral_link)
+                user = await session.scalar(stmt)
+            if user:
+                self._cache_user(user)
+            return user
         except Exception as e:
             logging.error(f"Error getting user by referral link: {e}")
             return None
 
-    def create_payout_request(self, user_id, amount, payment_method, details=""):
+    async def create_payout_request(self, user_id, amount, payment_method, details=""):
         try:
-            payout = Payout(
-                user_id=user_id,
-                amount=amount,
-                payment_method=payment_method,
-                details=details
-            )
-            self.session.add(payout)
-            self.session.commit()
-            return payout
+            async with self.Session() as session:
+                payout = Payout(
+                    user_id=user_id,
+                    amount=amount,
+                    payment_method=payment_method,
+                    details=details
+                )
+                session.add(payout)
+                await _bump_stats(session, user_id, pending_payouts=amount)
+                await session.commit()
+                return payout
         except Exception as e:
             logging.error(f"Error creating payout request: {e}")
-            self.session.rollback()
             return None
 
-    def get_user_payouts(self, user_id):
+    async def get_user_payouts(self, user_id):
         try:
-            stmt = select(Payout).where(Payout.user_id == user_id).order_by(Payout.requested_at.desc())
-            return list(self.session.scalars(stmt))
+            async with self.Session() as session:
+                stmt = select(Payout).where(Payout.user_id == user_id).order_by(Payout.requested_at.desc())
+                return list(await session.scalars(stmt))
         except Exception as e:
             logging.error(f"Error getting payouts for {user_id}: {e}")
             return []
 
-    def get_pending_payouts(self):
+    async def get_pending_payouts(self):
         try:
-            stmt = select(Payout).where(Payout.status == 'pending').order_by(Payout.requested_at)
-            return list(self.session.scalars(stmt))
+            async with self.Session() as session:
+                stmt = select(Payout).where(Payout.status == 'pending').order_by(Payout.requested_at)
+                return list(await session.scalars(stmt))
         except Exception as e:
             logging.error(f"Error getting pending payouts: {e}")
             return []
 
-    def update_payout_status(self, payout_id, status):
+    async def get_pending_payouts_page(self, after_id=None, before_id=None, limit=5):
+        """Страница очереди заявок вместе с именем партнёра, одним запросом.
+
+        Keyset-пагинация по (requested_at, id): after_id - страница после этой заявки,
+        before_id - перед ней, без курсора - первая страница. Возвращает (rows, has_more):
+        rows - [(Payout, username, first_name)] по возрастанию даты, has_more - есть ли
+        заявки дальше в направлении перехода.
+        """
+        try:
+            async with self.Session() as session:
+                stmt = (
+                    select(Payout, User.username, User.first_name)
+                    .outerjoin(User, User.user_id == Payout.user_id)
+                    .where(Payout.status == 'pending')
+                )
+                stmt = _payout_keyset(stmt, after_id, before_id)
+                rows = [tuple(row) for row in await session.execute(stmt.limit(limit + 1))]
+            has_more = len(rows) > limit
+            rows = rows[:limit]
+            if before_id is not None:
+                rows.reverse()
+            return rows, has_more
+        except Exception as e:
+            logging.error(f"Error getting pending payouts page: {e}")
+            return [], False
+
+    async def get_user_payouts_page(self, user_id, after_id=None, before_id=None, limit=10):
+        """Страница истории выплат партнёра, новые заявки первыми.
+
+        after_id - более старые заявки после этой, before_id - более новые перед ней.
+        Возвращает (payouts, has_more) как get_pending_payouts_page.
+        """
         try:
-            payout = self.session.get(Payout, payout_id)
-            if payout:
-                payout.status = status
-                payout.processed_at = datetime.now()
-                self.session.commit()
-            return payout
+            async with self.Session() as session:
+                stmt = _payout_keyset(
+                    select(Payout).where(Payout.user_id == user_id), after_id, before_id, newest_first=True
+                )
+                payouts = list(await session.scalars(stmt.limit(limit + 1)))
+            has_more = len(payouts) > limit
+            payouts = payouts[:limit]
+            if before_id is not None:
+                payouts.reverse()
+            return payouts, has_more
+        except Exception as e:
+            logging.error(f"Error getting payouts page for {user_id}: {e}")
+            return [], False
+
+    async def update_payout_status(self, payout_id, status):
+        try:
+            async with self.Session() as session:
+                payout = await session.get(Payout, payout_id)
+                if payout:
+                    old_bucket = _payout_bucket(payout.status)
+                    new_bucket = _payout_bucket(status)
+                    payout.status = status
+                    payout.processed_at = datetime.now()
+                    if old_bucket != new_bucket:
+                        deltas = {}
+                        if old_bucket:
+                            deltas[old_bucket] = -payout.amount
+                        if new_bucket:
+                            deltas[new_bucket] = payout.amount
+                        await _bump_stats(session, payout.user_id, **deltas)
+                    await session.commit()
+                return payout
         except Exception as e:
             logging.error(f"Error updating payout status: {e}")
-            self.session.rollback()
             return None
 
-    def get_all_users(self, signed_only=False):
+    def _pending_payouts_condition(self, payout_ids=None, max_amount=None, page=None):
+        condition = Payout.status == 'pending'
+        if payout_ids is not None:
+            condition = and_(condition, Payout.id.in_(payout_ids))
+        if max_amount is not None:
+            condition = and_(condition, Payout.amount <= max_amount)
+        if page is not None:
+            # Страница очереди от first_id до last_id включительно в порядке (requested_at, id)
+            first_id, last_id = page
+            payouts = Payout.__table__.alias('page_bounds')
+            first_at = select(payouts.c.requested_at).where(payouts.c.id == first_id).scalar_subquery()
+            last_at = select(payouts.c.requested_at).where(payouts.c.id == last_id).scalar_subquery()
+            condition = and_(
+                condition,
+                Payout.requested_at >= first_at,
+                or_(Payout.requested_at > first_at, Payout.id >= first_id),
+                Payout.requested_at <= last_at,
+                or_(Payout.requested_at < last_at, Payout.id <= last_id)
+            )
+        return condition
+
+    async def get_pending_payouts_summary(self, max_amount=None):
+        """(количество, сумма) ожидающих заявок, не больше max_amount, если задан"""
         try:
-            stmt = select(User)
-            if signed_only:
-                stmt = stmt.where(User.signed_agreement == True)
-            return list(self.session.scalars(stmt))
+            async with self.Session() as session:
+                row = (await session.execute(
+                    select(func.count(Payout.id), func.coalesce(func.sum(Payout.amount), 0))
+                    .where(self._pending_payouts_condition(max_amount=max_amount))
+                )).one()
+            return row[0], row[1] or 0
+        except Exception as e:
+            logging.error(f"Error getting pending payouts summary: {e}")
+            return 0, 0
+
+    async def moderate_payouts(self, status, payout_ids=None, max_amount=None, page=None):
+        """Массовое одобрение/отклонение ожидающих заявок одной транзакцией.
+
+        Меняются только заявки в статусе pending: выбранные payout_ids, страница
+        очереди page=(first_id, last_id) (как её показывает get_pending_payouts_page)
+        и/или не больше max_amount. Счётчики partner_stats обновляются одним
+        executemany. Возвращает [(payout_id, user_id, amount)] изменённых заявок.
+        """
+        if payout_ids is None and max_amount is None and page is None:
+            raise ValueError("Нужно указать payout_ids, page или max_amount")
+        if payout_ids is not None and not payout_ids:
+            return []
+        new_bucket = _payout_bucket(status)
+        try:
+            async with self.Session() as session:
+                result = await session.execute(
+                    update(Payout)
+                    .where(self._pending_payouts_condition(payout_ids, max_amount, page))
+                    .values(status=status, processed_at=datetime.now())
+                    .returning(Payout.id, Payout.user_id, Payout.amount)
+                    .execution_options(synchronize_session=False)
+                )
+                changed = [tuple(row) for row in result]
+
+                deltas = {}
+                for _, user_id, amount in changed:
+                    deltas[user_id] = deltas.get(user_id, 0) + amount
+                if deltas and new_bucket != 'pending_payouts':
+                    stmt = _dialect_insert(session, PartnerStats)
+                    set_ = {'pending_payouts': PartnerStats.pending_payouts + stmt.excluded.pending_payouts}
+                    if new_bucket:
+                        set_[new_bucket] = getattr(PartnerStats, new_bucket) + getattr(stmt.excluded, new_bucket)
+                    stmt = stmt.on_conflict_do_update(index_elements=[PartnerStats.user_id], set_=set_)
+                    await session.execute(stmt, [
+                        {'user_id': user_id, 'pending_payouts': -amount,
+                         'paid_payouts': amount if new_bucket == 'paid_payouts' else 0}
+                        for user_id, amount in deltas.items()
+                    ])
+                await session.commit()
+            return changed
+        except Exception as e:
+            logging.error(f"Error moderating payouts: {e}")
+            return []
+
+    async def get_all_users(self, signed_only=False, limit=None):
+        try:
+            async with self.Session() as session:
+                stmt = select(User)
+                if signed_only:
+                    stmt = stmt.where(User.signed_agreement == True)
+                if limit:
+                    stmt = stmt.order_by(User.id).limit(limit)
+                return list(await session.scalars(stmt))
         except Exception as e:
             logging.error(f"Error getting users: {e}")
             return []
 
-    def save_admin_message(self, admin_id, message_text, recipients_count):
+    async def get_audience_counts(self):
+        """Все счётчики аудиторий и админ-панели одним запросом.
+
+        Пользователи считаются по users, рефералы и ожидающие выплаты -
+        суммой по partner_stats вместо полного прохода по referrals и payouts.
+        audience_* - размеры аудиторий рассылки (без заблокировавших бота).
+        """
+        def count_where(condition):
+            return func.coalesce(func.sum(case((condition, 1), else_=0)), 0)
+
+        reachable = User.blocked_at.is_(None)
         try:
-            message = AdminMessage(
-                sent_by=admin_id,
-                message_text=message_text,
-                recipients_count=recipients_count
-            )
-            self.session.add(message)
-            self.session.commit()
-            return message
+            async with self.Session() as session:
+                row = (await session.execute(
+                    select(
+                        func.count(User.id),
+                        count_where(User.signed_agreement == True),
+                        count_where(reachable),
+                        count_where(and_(reachable, User.signed_agreement == True)),
+                        select(func.coalesce(func.sum(PartnerStats.total_referrals), 0)).scalar_subquery(),
+                        select(func.coalesce(func.sum(PartnerStats.pending_payouts), 0)).scalar_subquery()
+                    )
+                )).one()
+            total_users, signed_users, audience_all, audience_signed, total_referrals, pending_payouts = row
+            return {
+                'total_users': total_users,
+                'signed_users': signed_users,
+                'unsigned_users': total_users - signed_users,
+                'blocked_users': total_users - audience_all,
+                'audience_all': audience_all,
+                'audience_signed': audience_signed,
+                'audience_unsigned': audience_all - audience_signed,
+                'total_referrals': total_referrals,
+                'pending_payouts': pending_payouts or 0
+            }
+        except Exception as e:
+            logging.error(f"Error getting audience counts: {e}")
+            return {'total_users': 0, 'signed_users': 0, 'unsigned_users': 0, 'blocked_users': 0,
+                    'audience_all': 0, 'audience_signed': 0, 'audience_unsigned': 0,
+                    'total_referrals': 0, 'pending_payouts': 0}
+
+    async def refresh_dashboard(self, history_days=2):
+        """Пересчёт dashboard_snapshot и daily_stats за последние history_days дней.
+
+        Вызывается фоновой задачей; пока истории нет, daily_stats заполняется
+        за всё время. Дни считаются по индексированным датам событий.
+        """
+        def per_day(column, value=None, *conditions):
+            day = func.date(column)
+            aggregate = func.count() if value is None else func.coalesce(func.sum(value), 0)
+            stmt = select(day, aggregate).where(column.isnot(None), *conditions)
+            if since:
+                stmt = stmt.where(column >= since)
+            return stmt.group_by(day)
+
+        try:
+            async with self.Session() as session:
+                since = None
+                if await session.scalar(select(DailyStats.day).limit(1)):
+                    since = datetime.combine(datetime.now().date() - timedelta(days=history_days - 1), datetime.min.time())
+
+                total_users, signed_users, blocked_users, total_referrals, confirmed_referrals, pending, paid = (
+                    await session.execute(select(
+                        func.count(User.id),
+                        func.coalesce(func.sum(case((User.signed_agreement == True, 1), else_=0)), 0),
+                        func.coalesce(func.sum(case((User.blocked_at.isnot(None), 1), else_=0)), 0),
+                        select(func.coalesce(func.sum(PartnerStats.total_referrals), 0)).scalar_subquery(),
+                        select(func.coalesce(func.sum(PartnerStats.confirmed_referrals), 0)).scalar_subquery(),
+                        select(func.coalesce(func.sum(PartnerStats.pending_payouts), 0)).scalar_subquery(),
+                        select(func.coalesce(func.sum(PartnerStats.paid_payouts), 0)).scalar_subquery()
+                    ))
+                ).one()
+                snapshot = dict(
+                    total_users=total_users, signed_users=signed_users, blocked_users=blocked_users,
+                    total_referrals=total_referrals, confirmed_referrals=confirmed_referrals,
+                    pending_payouts=pending, paid_payouts=paid, refreshed_at=datetime.now()
+                )
+                stmt = _dialect_insert(session, DashboardSnapshot).values(id=1, **snapshot)
+                await session.execute(stmt.on_conflict_do_update(index_elements=[DashboardSnapshot.id], set_=snapshot))
+
+                days = defaultdict(dict)
+                for name, stmt in (
+                    ('signups', per_day(User.created_at)),
+                    ('signed', per_day(User.signed_at)),
+                    ('confirmed_referrals', per_day(Referral.confirmed_at, None, Referral.confirmed == True)),
+                    ('payouts_requested', per_day(Payout.requested_at, Payout.amount)),
+                    ('payouts_paid', per_day(Payout.processed_at, Payout.amount, Payout.status.in_(PAID_STATUSES))),
+                ):
+                    for day, value in await session.execute(stmt):
+                        days[str(day)[:10]][name] = value
+                # Дни пересчитанного периода заменяются целиком
+                stale = delete(DailyStats)
+                if since:
+                    stale = stale.where(DailyStats.day >= since.date().isoformat())
+                await session.execute(stale)
+                if days:
+                    await session.execute(
+                        DailyStats.__table__.insert(),
+                        [
+                            {'day': day, 'signups': 0, 'signed': 0, 'confirmed_referrals': 0,
+                             'payouts_requested': 0, 'payouts_paid': 0, **values}
+                            for day, values in days.items()
+                        ]
+                    )
+                await session.commit()
+        except Exception as e:
+            logging.error(f"Error refreshing dashboard: {e}")
+
+    async def get_dashboard(self, history_days=7):
+        """Последний снимок админ-панели и история за history_days дней (новые первыми).
+
+        Пока снимок не рассчитан, возвращается нулевой с refreshed_at=None.
+        """
+        try:
+            async with self.Session() as session:
+                snapshot = await session.get(DashboardSnapshot, 1)
+                history = list(await session.scalars(
+                    select(DailyStats).order_by(DailyStats.day.desc()).limit(history_days)
+                ))
+                return snapshot or _empty_dashboard(), history
+        except Exception as e:
+            logging.error(f"Error getting dashboard: {e}")
+            return _empty_dashboard(), []
+
+    async def rebuild_partner_stats(self):
+        """Полный пересчёт счётчиков партнёров из исходных таблиц"""
+        async with self.engine.begin() as conn:
+            await conn.run_sync(rebuild_partner_stats)
+
+    async def rebuild_referral_tree(self):
+        """Полный пересчёт дерева рефералов и счётчиков по уровням"""
+        async with self.engine.begin() as conn:
+            await conn.run_sync(rebuild_referral_tree)
+
+    async def create_broadcast_job(self, admin_id, message_text, audience, progress_chat_id=None,
+                                   progress_message_id=None, include_blocked=False):
+        """Создаёт задание и фиксирует список получателей одним INSERT ... SELECT.
+
+        Пользователи с blocked_at по умолчанию не попадают в рассылку.
+        """
+        try:
+            async with self.Session() as session:
+                job = BroadcastJob(
+                    message_text=message_text,
+                    audience=audience,
+                    created_by=admin_id,
+                    progress_chat_id=progress_chat_id,
+                    progress_message_id=progress_message_id
+                )
+                session.add(job)
+                await session.flush()
+
+                result = await session.execute(
+                    BroadcastRecipient.__table__.insert().from_select(
+                        ['job_id', 'user_id'],
+                        select(literal(job.id), User.user_id).where(_audience_condition(audience, include_blocked))
+                    )
+                )
+                job.total_count = result.rowcount
+                await session.commit()
+                return job
+        except Exception as e:
+            logging.error(f"Error creating broadcast job: {e}")
+            return None
+
+    async def get_unfinished_broadcast_jobs(self):
+        try:
+            async with self.Session() as session:
+                stmt = select(BroadcastJob).where(BroadcastJob.status == 'running').order_by(BroadcastJob.id)
+                return list(await session.scalars(stmt))
+        except Exception as e:
+            logging.error(f"Error getting unfinished broadcast jobs: {e}")
+            return []
+
+    async def claim_broadcast_recipients(self, job_id, limit):
+        """Переводит следующую порцию получателей в sending и возвращает их user_id.
+
+        Читается только колонка user_id, результат - компактный array('q'),
+        так что память не зависит от размера аудитории.
+        """
+        try:
+            async with self.Session() as session:
+                user_ids = array('q', await session.scalars(
+                    select(BroadcastRecipient.user_id)
+                    .where(BroadcastRecipient.job_id == job_id, BroadcastRecipient.status == 'queued')
+                    .order_by(BroadcastRecipient.user_id)
+                    .limit(limit)
+                ))
+                if user_ids:
+                    await session.execute(
+                        update(BroadcastRecipient)
+                        .where(BroadcastRecipient.job_id == job_id, BroadcastRecipient.user_id.in_(user_ids.tolist()))
+                        .values(status='sending', updated_at=datetime.now())
+                    )
+                    await session.commit()
+                return user_ids
+        except Exception as e:
+            logging.error(f"Error claiming recipients for broadcast {job_id}: {e}")
+            return array('q')
+
+    async def release_broadcast_recipients(self, job_id, user_ids):
+        """Возвращает в очередь получателей, забранных claim_broadcast_recipients, но не отправленных"""
+        try:
+            async with self.Session() as session:
+                await session.execute(
+                    update(BroadcastRecipient)
+                    .where(BroadcastRecipient.job_id == job_id, BroadcastRecipient.user_id.in_(user_ids.tolist()))
+                    .values(status='queued', updated_at=datetime.now())
+                )
+                await session.commit()
+        except Exception as e:
+            logging.error(f"Error releasing recipients for broadcast {job_id}: {e}")
+
+    async def save_broadcast_results(self, job_id, results):
+        """results - список (user_id, status, error); записывается одной транзакцией"""
+        try:
+            async with self.Session() as session:
+                now = datetime.now()
+                await session.execute(
+                    update(BroadcastRecipient),
+                    [
+                        {'job_id': job_id, 'user_id': user_id, 'status': status, 'error': error, 'updated_at': now}
+                        for user_id, status, error in results
+                    ]
+                )
+                # Ошибки доставки сохраняются у пользователя, недоступные чаты помечаются blocked_at
+                users = User.__table__
+                failures = [
+                    {'b_user_id': user_id, 'b_error': error}
+                    for user_id, status, error in results if status == 'failed'
+                ]
+                blocked = [
+                    {'b_user_id': user_id, 'b_error': error}
+                    for user_id, status, error in results if status == 'blocked'
+                ]
+                if failures:
+                    await session.execute(
+                        update(users)
+                        .where(users.c.user_id == bindparam('b_user_id'))
+                        .values(last_delivery_error=bindparam('b_error')),
+                        failures
+                    )
+                if blocked:
+                    await session.execute(
+                        update(users)
+                        .where(users.c.user_id == bindparam('b_user_id'))
+                        .values(last_delivery_error=bindparam('b_error'), blocked_at=now),
+                        blocked
+                    )
+
+                sent = sum(1 for _, status, _ in results if status == 'sent')
+                await session.execute(
+                    update(BroadcastJob)
+                    .where(BroadcastJob.id == job_id)
+                    .values(
+                        sent_count=BroadcastJob.sent_count + sent,
+                        failed_count=BroadcastJob.failed_count + (len(results) - sent)
+                    )
+                )
+                await session.commit()
+            for item in blocked:
+                self.invalidate_user(item['b_user_id'])
+        except Exception as e:
+            logging.error(f"Error saving results for broadcast {job_id}: {e}")
+
+    async def fail_interrupted_recipients(self, job_id):
+        """Получатели в статусе sending после падения: доставка неизвестна, повторно не отправляем"""
+        try:
+            async with self.Session() as session:
+                result = await session.execute(
+                    update(BroadcastRecipient)
+                    .where(BroadcastRecipient.job_id == job_id, BroadcastRecipient.status == 'sending')
+                    .values(status='failed', error='interrupted', updated_at=datetime.now())
+                )
+                await session.execute(
+                    update(BroadcastJob)
+                    .where(BroadcastJob.id == job_id)
+                    .values(failed_count=BroadcastJob.failed_count + result.rowcount)
+                )
+                await session.commit()
+                return result.rowcount
+        except Exception as e:
+            logging.error(f"Error resetting interrupted recipients for broadcast {job_id}: {e}")
+            return 0
+
+    async def finish_broadcast_job(self, job_id):
+        try:
+            async with self.Session() as session:
+                job = await session.get(BroadcastJob, job_id)
+                if job:
+                    job.status = 'done'
+                    job.finished_at = datetime.now()
+                    session.add(AdminMessage(
+                        sent_by=job.created_by,
+                        message_text=job.message_text,
+                        recipients_count=job.sent_count
+                    ))
+                    await session.commit()
+                return job
+        except Exception as e:
+            logging.error(f"Error finishing broadcast {job_id}: {e}")
+            return None
+
+    async def get_scheduled_messages(self):
+        """Все неотправленные отложенные сообщения в порядке отправки"""
+        try:
+            async with self.Session() as session:
+                stmt = select(ScheduledMessage).order_by(ScheduledMessage.send_at, ScheduledMessage.id)
+                return list(await session.scalars(stmt))
+        except Exception as e:
+            logging.error(f"Error getting scheduled messages: {e}")
+            return []
+
+    async def delete_scheduled_message(self, message_id):
+        try:
+            async with self.Session() as session:
+                await session.execute(delete(ScheduledMessage).where(ScheduledMessage.id == message_id))
+                await session.commit()
+        except Exception as e:
+            logging.error(f"Error deleting scheduled message {message_id}: {e}")
+
+    async def get_referral_notifications(self, limit=5000):
+        """Самые старые неотправленные уведомления рефереров"""
+        try:
+            async with self.Session() as session:
+                stmt = select(ReferralNotification).order_by(ReferralNotification.id).limit(limit)
+                return list(await session.scalars(stmt))
+        except Exception as e:
+            logging.error(f"Error getting referral notifications: {e}")
+            return []
+
+    async def delete_referral_notifications(self, notification_ids):
+        try:
+            async with self.Session() as session:
+                await session.execute(delete(ReferralNotification).where(ReferralNotification.id.in_(notification_ids)))
+                await session.commit()
+        except Exception as e:
+            logging.error(f"Error deleting referral notifications: {e}")
+
+    async def save_admin_message(self, admin_id, message_text, recipients_count):
+        try:
+            async with self.Session() as session:
+                message = AdminMessage(
+                    sent_by=admin_id,
+                    message_text=message_text,
+                    recipients_count=recipients_count
+                )
+                session.add(message)
+                await session.commit()
+                return message
         except Exception as e:
             logging.error(f"Error saving admin message: {e}")
-            self.session.rollback()
             return None
\ No newline at end of file
@@ -92,4 +92,48 @@ def get_payout_management_keyboard(payout_id):
         ],
         [InlineKeyboardButton("🔙 Назад", callback_data="back_to_admin")]
     ]
+    return InlineKeyboardMarkup(keyboard)
+
+def get_payout_queue_keyboard(payouts, has_prev=False, has_next=False, bulk_max_amount=None):
+    keyboard = [
+        [
+            InlineKeyboardButton(f"✅ #{payout.id}", callback_data=f"approve_{payout.id}"),
+            InlineKeyboardButton(f"❌ #{payout.id}", callback_data=f"reject_{payout.id}")
+        ]
+        for payout in payouts
+    ]
+    page = f"{payouts[0].id}_{payouts[-1].id}"
+    keyboard.append([
+        InlineKeyboardButton("✅ Одобрить страницу", callback_data=f"bulk_approved_page_{page}"),
+        InlineKeyboardButton("❌ Отклонить страницу", callback_data=f"bulk_rejected_page_{page}")
+    ])
+    if bulk_max_amount:
+        keyboard.append([InlineKeyboardButton(
+            f"✅ Все до {bulk_max_amount} руб.", callback_data=f"bulk_approved_under_{bulk_max_amount}"
+        )])
+    navigation = []
+    if has_prev:
+        navigation.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"payouts_prev_{payouts[0].id}"))
+    if has_next:
+        navigation.append(InlineKeyboardButton("Далее ➡️", callback_data=f"payouts_next_{payouts[-1].id}"))
+    if navigation:
+        keyboard.append(navigation)
+    keyboard.append([InlineKeyboardButton("🔙 В админ-панель", callback_data="back_to_admin")])
+    return InlineKeyboardMarkup(keyboard)
+
+def get_payout_history_keyboard(payouts, has_prev=False, has_next=False):
+    navigation = []
+    if has_prev:
+        navigation.append(InlineKeyboardButton("⬅️ Новее", callback_data=f"history_prev_{payouts[0].id}"))
+    if has_next:
+        navigation.append(InlineKeyboardButton("Старее ➡️", callback_data=f"history_next_{payouts[-1].id}"))
+    keyboard = [navigation] if navigation else []
+    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="back_to_payouts")])
+    return InlineKeyboardMarkup(keyboard)
+
+def get_bulk_moderation_keyboard(status, max_amount):
+    keyboard = [
+        [InlineKeyboardButton("✅ Подтвердить", callback_data=f"bulk_{status}_confirm_{max_amount}")],
+        [InlineKeyboardButton("🔙 Назад", callback_data="payout_requests")]
+    ]
     return InlineKeyboardMarkup(keyboard)
\ No newline at end of file
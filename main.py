@@ -1,19 +1,26 @@
+import json
 import logging
-import asyncio
+import math
 from datetime import datetime
-from telegram import Update
+from telegram import InlineKeyboardMarkup, Update
+from telegram.error import RetryAfter
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters
-from sqlalchemy import select, func
 import os
 from config import Config
-from database import Database, User, Referral, Payout
+from database import Database
 from keyboards import (
     get_main_menu_keyboard, get_agreement_keyboard, get_admin_keyboard,
     get_payouts_keyboard, get_payment_methods_keyboard, get_broadcast_keyboard,
     get_back_keyboard, get_payout_management_keyboard, get_recipients_keyboard,
-    get_broadcast_confirmation_keyboard
+    get_broadcast_confirmation_keyboard, get_payout_queue_keyboard, get_payout_history_keyboard,
+    get_bulk_moderation_keyboard
 )
 from messages import Messages
+from update_processor import UserOrderedUpdateProcessor
+from broadcast import BroadcastDispatcher, TokenBucket, is_safe_to_retry
+import metrics
+from sql_profiler import SQLProfiler
+from referral_tokens import PREFIX as REFERRAL_TOKEN_PREFIX
 
 # Настройка логирования
 logging.basicConfig(
@@ -21,6 +28,13 @@ logging.basicConfig(
     level=logging.INFO
 )
 
+# Тип получателей рассылки -> ключ в Database.get_audience_counts()
+AUDIENCE_COUNT_KEYS = {
+    'all': 'audience_all',
+    'signed': 'audience_signed',
+    'unsigned': 'audience_unsigned'
+}
+
 # Глобальные переменные для хранения состояния рассылки
 broadcast_data = {
     'text': None,
@@ -29,9 +43,48 @@ broadcast_data = {
 }
 
 class PartnerBot:
-    def __init__(self, token):
-        self.application = Application.builder().token(token).build()
-        self.db = Database()
+    def __init__(self, token, base_url=None):
+        self.sql_profiler = None
+        if Config.SQL_PROFILE:
+            self.sql_profiler = SQLProfiler(Config.SQL_PROFILE_REPEAT_THRESHOLD, Config.SQL_PROFILE_REPORT_EVERY)
+        builder = (
+            Application.builder()
+            .token(token)
+            .concurrent_updates(UserOrderedUpdateProcessor(Config.CONCURRENT_UPDATES, self.sql_profiler))
+            # Замер времени и ошибок вызовов Bot API
+            .request(metrics.MetricsRequest(connection_pool_size=256))
+            .get_updates_request(metrics.MetricsRequest())
+            .post_init(self.on_startup)
+            .post_stop(self.on_stop)
+            .post_shutdown(self.on_shutdown)
+        )
+        base_url = base_url or Config.BOT_API_BASE_URL
+        if base_url:
+            # Свой Bot API сервер: self-hosted или фейковый для нагрузочных тестов
+            builder = builder.base_url(base_url)
+        self.application = builder.build()
+        self.db = Database(
+            Config.DATABASE_URL, Config.USER_CACHE_SIZE, Config.USER_CACHE_TTL,
+            Config.WRITE_BATCH_SIZE, Config.WRITE_BATCH_DELAY,
+            # Без REFERRAL_SECRET ключ выводится из токена бота (ссылки сменятся вместе с токеном)
+            referral_secret=Config.REFERRAL_SECRET or f"referral:{token}"
+        )
+        metrics.instrument_engine(self.db.engine)
+        if self.sql_profiler:
+            self.sql_profiler.instrument_engine(self.db.engine)
+        # Общий лимит скорости отправки для всех рассылок бота
+        self.broadcast_bucket = TokenBucket(Config.BROADCAST_RATE)
+        self.broadcast_dispatcher = BroadcastDispatcher(
+            self.db,
+            self.broadcast_bucket,
+            workers=Config.BROADCAST_WORKERS,
+            per_chat_interval=Config.BROADCAST_PER_CHAT_INTERVAL,
+            batch_size=Config.BROADCAST_BATCH_SIZE,
+            max_attempts=Config.BROADCAST_MAX_ATTEMPTS,
+            progress_interval=Config.BROADCAST_PROGRESS_INTERVAL
+        )
+        metrics.track_broadcasts(self.broadcast_dispatcher)
+        self.metrics_server = None
         self.broadcast_data = {
             'text': None,
             'recipients': 'all',
@@ -39,6 +92,113 @@ class PartnerBot:
         }
         self.setup_handlers()
 
+    async def on_startup(self, application):
+        await self.db.init()
+        await self.broadcast_dispatcher.resume(application.bot)
+        await self.restore_scheduled_messages()
+        application.job_queue.run_repeating(
+            self.send_referral_digests, Config.REFERRAL_DIGEST_INTERVAL, name='referral_digests'
+        )
+        application.job_queue.run_repeating(
+            self.refresh_dashboard, Config.DASHBOARD_REFRESH_INTERVAL, first=0, name='refresh_dashboard'
+        )
+        if Config.METRICS_PORT:
+            self.metrics_server = await metrics.start_metrics_server(Config.METRICS_HOST, Config.METRICS_PORT)
+
+    def schedule_message(self, message_id, chat_id, text, send_at=None, delay=None, reply_markup=None):
+        """Отправка сохранённого ScheduledMessage задачей JobQueue"""
+        if delay is None:
+            # Задержка в секундах, а не datetime: send_at хранится в локальном времени без tz
+            delay = max(0.0, (send_at - datetime.now()).total_seconds())
+        self.application.job_queue.run_once(
+            self.send_scheduled_message, delay,
+            data=(message_id, text, reply_markup), chat_id=chat_id, name=f"scheduled_message_{message_id}"
+        )
+
+    async def restore_scheduled_messages(self):
+        """Планирует сообщения, не отправленные до перезапуска, сохраняя интервал внутри чата"""
+        next_delay = {}
+        messages = await self.db.get_scheduled_messages()
+        for message in messages:
+            delay = max(0.0, (message.send_at - datetime.now()).total_seconds(), next_delay.get(message.chat_id, 0.0))
+            next_delay[message.chat_id] = delay + Config.WELCOME_MESSAGE_INTERVAL
+            self.schedule_message(message.id, message.chat_id, message.text, delay=delay,
+                                  reply_markup=message.reply_markup)
+        if messages:
+            logging.info(f"Восстановлено отложенных сообщений: {len(messages)}")
+
+    async def send_scheduled_message(self, context: ContextTypes.DEFAULT_TYPE):
+        """Задача JobQueue: отправка в общем лимите скорости, запись удаляется после отправки"""
+        message_id, text, reply_markup = context.job.data
+        chat_id = context.job.chat_id
+        keyboard = InlineKeyboardMarkup.de_json(json.loads(reply_markup), context.bot) if reply_markup else None
+        await self.broadcast_bucket.acquire()
+        try:
+            await context.bot.send_message(chat_id=chat_id, text=text, reply_markup=keyboard)
+        except RetryAfter as e:
+            self.broadcast_bucket.pause(e.retry_after)
+            self.schedule_message(message_id, chat_id, text, delay=e.retry_after, reply_markup=reply_markup)
+            return
+        except Exception as e:
+            if is_safe_to_retry(e):
+                # Запрос не дошёл до Telegram: запись остаётся в БД, повторяем позже
+                logging.warning(f"Отложенное сообщение {message_id} для {chat_id} не отправлено, повтор: {e}")
+                self.schedule_message(message_id, chat_id, text, delay=Config.WELCOME_RETRY_DELAY,
+                                      reply_markup=reply_markup)
+                return
+            # В т.ч. TimedOut: сообщение могло быть доставлено, повтор отправил бы его дважды
+            logging.warning(f"Отложенное сообщение {message_id} для {chat_id} не доставлено: {e}")
+        await self.db.delete_scheduled_message(message_id)
+
+    async def send_referral_digests(self, context: ContextTypes.DEFAULT_TYPE):
+        """Задача JobQueue: одно сообщение на реферера за все регистрации с прошлого прохода"""
+        notifications = await self.db.get_referral_notifications(Config.REFERRAL_DIGEST_BATCH)
+        if not notifications:
+            return
+        grouped = {}
+        for notification in notifications:
+            grouped.setdefault(notification.referrer_id, []).append(notification)
+        now = datetime.now()
+        messages = {}
+        for referrer_id, items in grouped.items():
+            minutes = max(1, math.ceil((now - items[0].created_at).total_seconds() / 60))
+            messages[referrer_id] = Messages.get_referral_digest_text([item.referred_name for item in items], minutes)
+        await self.broadcast_dispatcher.send_notifications(context.bot, messages)
+        # Недоставленные тоже удаляются: сводка не критична, а заблокированный чат не оживёт
+        await self.db.delete_referral_notifications([notification.id for notification in notifications])
+
+    async def refresh_dashboard(self, context: ContextTypes.DEFAULT_TYPE):
+        """Задача JobQueue: пересчёт снимка статистики админ-панели"""
+        await self.db.refresh_dashboard()
+
+    async def on_stop(self, application):
+        await self.broadcast_dispatcher.stop()
+
+    async def on_shutdown(self, application):
+        if self.sql_profiler:
+            self.sql_profiler.log_summary()
+        if self.metrics_server:
+            self.metrics_server.close()
+            await self.metrics_server.wait_closed()
+        await self.db.close()
+
+    def run(self):
+        """Webhook, если задан WEBHOOK_URL, иначе long polling"""
+        if Config.WEBHOOK_URL:
+            print(f"🌐 Webhook: {Config.WEBHOOK_LISTEN}:{Config.WEBHOOK_PORT}/{Config.WEBHOOK_PATH}")
+            # Telegram передаёт secret_token в заголовке X-Telegram-Bot-Api-Secret-Token,
+            # запросы без него отклоняются
+            self.application.run_webhook(
+                listen=Config.WEBHOOK_LISTEN,
+                port=Config.WEBHOOK_PORT,
+                url_path=Config.WEBHOOK_PATH,
+                secret_token=Config.WEBHOOK_SECRET,
+                webhook_url=f"{Config.WEBHOOK_URL.rstrip('/')}/{Config.WEBHOOK_PATH}"
+            )
+        else:
+            # Простой запуск без сложных retry-механизмов
+            self.application.run_polling()
+
     def setup_handlers(self):
         # Команды
         self.application.add_handler(CommandHandler("start", self.start))
@@ -52,23 +212,44 @@ class PartnerBot:
     async def debug_users(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
             """Временная команда для отладки"""
             if update.effective_user.id == Config.ADMIN_ID:
-                users_all = self.db.get_all_users()
-                users_signed = self.db.get_all_users(signed_only=True)
+                counts = await self.db.get_audience_counts()
+                sample_users = await self.db.get_all_users(limit=5)  # Покажем первых 5
 
                 text = f"""🐞 *Отладочная информация*
 
     📊 База данных:
-    • Всего пользователей: {len(users_all)}
-    • Подписавших соглашение: {len(users_signed)}
-    • Неподписавших: {len(users_all) - len(users_signed)}
+    • Всего пользователей: {counts['total_users']}
+    • Подписавших соглашение: {counts['signed_users']}
+    • Неподписавших: {counts['unsigned_users']}
 
     👥 Примеры пользователей:"""
 
-                for i, user in enumerate(users_all[:5]):  # Покажем первых 5
+                for i, user in enumerate(sample_users):
                     text += f"\n{i + 1}. ID: {user.user_id}, Имя: {user.first_name}, Подписал: {user.signed_agreement}"
 
+                cache_stats = self.db.user_cache.stats()
+                text += (f"\n\n    🗄 Кэш партнёров: {cache_stats['size']} записей, "
+                         f"попаданий {cache_stats['hits']}, промахов {cache_stats['misses']} "
+                         f"({cache_stats['hit_rate']:.0%})")
+
                 await update.message.reply_text(text)
 
+    async def finish_bulk_moderation(self, query, context, status, changed):
+        """Итог массовой обработки админу и уведомления партнёрам (одно сообщение на партнёра)"""
+        by_user = {}
+        for payout_id, user_id, amount in changed:
+            by_user.setdefault(user_id, []).append((payout_id, amount))
+        if by_user:
+            self.broadcast_dispatcher.notify(context.bot, {
+                user_id: Messages.get_payouts_moderated_text(status, payouts)
+                for user_id, payouts in by_user.items()
+            })
+        await self.safe_edit_message(
+            query,
+            Messages.get_bulk_moderation_result_text(status, len(changed), sum(amount for _, _, amount in changed)),
+            get_back_keyboard("payout_requests")
+        )
+
     async def safe_edit_message(self, query, text, reply_markup=None, parse_mode=None):
         try:
             await query.edit_message_text(
@@ -88,32 +269,37 @@ class PartnerBot:
 
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user = update.effective_user
-        db_user = self.db.get_user(user.id)
-
-        # Обработка реферальной ссылки
-        if context.args:
-            ref_link = context.args[0]
-            if ref_link.startswith('ref_'):
-                if not db_user:
-                    db_user = self.db.create_user(user)
-                    ref_owner = self.db.get_user_by_referral_link(ref_link)
-                    if ref_owner and ref_owner.user_id != user.id:
-                        self.db.add_referral(ref_owner.user_id, user.id)
-                        if db_user and db_user.signed_agreement:
-                            self.db.confirm_referral(user.id)
-                        try:
-                            await context.bot.send_message(
-                                chat_id=ref_owner.user_id,
-                                text=f"🎉 По вашей ссылке зарегистрировался новый партнёр: {user.first_name}"
-                            )
-                        except Exception as e:
-                            logging.error(f"Ошибка уведомления реферера: {e}")
+        db_user = await self.db.get_user(user.id)
+
+        # Пользователь снова запустил бота - возвращаем его в рассылки
+        if db_user and db_user.blocked_at:
+            db_user = await self.db.mark_user_reachable(user.id) or db_user
 
         if not db_user:
-            db_user = self.db.create_user(user)
-            for message in Messages.get_offer_messages():
-                await update.message.reply_text(message)
-                await asyncio.sleep(1)
+            # Реферальная ссылка: подписанная p_... проверяется в памяти, старая ref_... - по БД
+            referral_link = context.args[0] if context.args else ''
+            is_referral = referral_link.startswith(('ref_', REFERRAL_TOKEN_PREFIX))
+            referrer_id = await self.db.resolve_referrer_id(referral_link) if is_referral else None
+
+            # Приветственная серия - только без реферальной ссылки; отправляется фоновыми задачами,
+            # меню с клавиатурой - последним сообщением серии, как и раньше после предложений
+            # Уведомление рефереру пишется в ту же транзакцию и уходит сводкой (send_referral_digests)
+            welcome_messages = ()
+            if not is_referral:
+                welcome_messages = [(message, None) for message in Messages.get_offer_messages()]
+                welcome_messages.append(
+                    (Messages.get_welcome_message(user.first_name), get_main_menu_keyboard(False).to_json())
+                )
+            db_user, _, _, scheduled = await self.db.onboard_user(
+                user, referrer_id,
+                welcome_messages=welcome_messages,
+                welcome_interval=Config.WELCOME_MESSAGE_INTERVAL
+            )
+            for message in scheduled:
+                self.schedule_message(message.id, message.chat_id, message.text, message.send_at,
+                                      reply_markup=message.reply_markup)
+            if scheduled:
+                return
 
         keyboard = get_main_menu_keyboard(db_user.signed_agreement if db_user else False)
         await update.message.reply_text(
@@ -123,13 +309,13 @@ class PartnerBot:
 
     async def stats(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user = update.effective_user
-        db_user = self.db.get_user(user.id)
+        db_user = await self.db.get_user(user.id)
 
         if not db_user or not db_user.signed_agreement:
             await update.message.reply_text("❌ Доступно только после подписания соглашения")
             return
 
-        stats = self.db.get_user_stats(user.id)
+        stats = await self.db.get_user_stats(user.id)
         bot_username = (await context.bot.get_me()).username
         ref_link = f"https://t.me/{bot_username}?start={db_user.referral_link}"
 
@@ -138,13 +324,13 @@ class PartnerBot:
 
     async def payout(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user = update.effective_user
-        db_user = self.db.get_user(user.id)
+        db_user = await self.db.get_user(user.id)
 
         if not db_user or not db_user.signed_agreement:
             await update.message.reply_text("❌ Доступно только после подписания соглашения")
             return
 
-        stats = self.db.get_user_stats(user.id)
+        stats = await self.db.get_user_stats(user.id)
         payouts_text = Messages.get_payouts_text(stats)
         await update.message.reply_text(
             payouts_text,
@@ -186,12 +372,12 @@ class PartnerBot:
                     await update.message.reply_text(f"❌ Минимальная сумма выплаты {Config.MIN_PAYOUT} руб.")
                     return
 
-                stats = self.db.get_user_stats(user.id)
+                stats = await self.db.get_user_stats(user.id)
                 if amount > stats['available_balance']:
                     await update.message.reply_text("❌ Недостаточно средств для выплаты")
                     return
 
-                payout = self.db.create_payout_request(user.id, amount, payment_method, details)
+                payout = await self.db.create_payout_request(user.id, amount, payment_method, details)
                 if payout:
                     context.user_data.pop('awaiting_payout', None)
                     context.user_data.pop('payment_method', None)
@@ -231,54 +417,26 @@ class PartnerBot:
             context.user_data.pop('awaiting_broadcast_text', None)
 
             # Получаем количество пользователей
-            if self.broadcast_data['recipients'] == 'all':
-                users = self.db.get_all_users()
-            elif self.broadcast_data['recipients'] == 'signed':
-                users = self.db.get_all_users(signed_only=True)
-            else:
-                users = self.db.get_all_users(signed_only=False)
-
-            self.broadcast_data['users_count'] = len(users)
+            counts = await self.db.get_audience_counts()
+            users_count = counts[AUDIENCE_COUNT_KEYS[self.broadcast_data['recipients']]]
+            self.broadcast_data['users_count'] = users_count
 
-            print(f"👥 Получателей: {len(users)}")
+            print(f"👥 Получателей: {users_count}")
 
             await update.message.reply_text(
                 f"✅ Текст рассылки сохранен!\n\n"
                 f"Получатели: {self.broadcast_data['recipients']}\n"
-                f"Количество: {len(users)} пользователей\n\n"
+                f"Количество: {users_count} пользователей\n\n"
                 f"Теперь вы можете начать рассылку.",
                 reply_markup=get_broadcast_keyboard()
             )
 
-    async def send_broadcast_message(self, context, user_id, message_text):
-        """Отправка сообщения пользователю с обработкой ошибок"""
-        try:
-            await context.bot.send_message(
-                chat_id=user_id,
-                text=message_text
-            )
-            print(f"✅ Сообщение отправлено пользователю {user_id}")
-            return True
-        except Exception as e:
-            error_msg = str(e)
-            print(f"❌ Ошибка отправки пользователю {user_id}: {error_msg}")
-
-            # Логируем разные типы ошибок
-            if "Forbidden" in error_msg:
-                print(f"   Пользователь {user_id} заблокировал бота")
-            elif "Chat not found" in error_msg:
-                print(f"   Чат с пользователем {user_id} не найден")
-            elif "bot was blocked" in error_msg.lower():
-                print(f"   Бот заблокирован пользователем {user_id}")
-
-            return False
-
     async def button_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
             query = update.callback_query
             await query.answer()
 
             user = query.from_user
-            db_user = self.db.get_user(user.id)
+            db_user = await self.db.get_user(user.id)
 
             try:
                 if query.data == "about":
@@ -304,12 +462,11 @@ class PartnerBot:
 
                 elif query.data == "confirm_agreement":
                     if db_user:
-                        self.db.sign_agreement(user.id)
-                        stmt = select(Referral).where(Referral.referred_id == user.id)
-                        referrals = self.db.session.scalars(stmt).all()
+                        await self.db.sign_agreement(user.id)
+                        referrals = await self.db.get_referrals_by_referred(user.id)
 
                         for referral in referrals:
-                            self.db.confirm_referral(referral.referred_id)
+                            await self.db.confirm_referral(referral.referred_id)
 
                         await self.safe_edit_message(
                             query,
@@ -331,7 +488,7 @@ class PartnerBot:
                     )
 
                 elif query.data == "stats" and db_user and db_user.signed_agreement:
-                    stats = self.db.get_user_stats(user.id)
+                    stats = await self.db.get_user_stats(user.id)
                     bot_username = (await context.bot.get_me()).username
                     ref_link = f"https://t.me/{bot_username}?start={db_user.referral_link}"
 
@@ -359,7 +516,7 @@ class PartnerBot:
                     )
 
                 elif query.data == "payouts" and db_user and db_user.signed_agreement:
-                    stats = self.db.get_user_stats(user.id)
+                    stats = await self.db.get_user_stats(user.id)
                     payouts_text = Messages.get_payouts_text(stats)
                     await self.safe_edit_message(
                         query,
@@ -382,7 +539,7 @@ class PartnerBot:
                     )
 
                 elif query.data == "back_to_payouts":
-                    stats = self.db.get_user_stats(user.id)
+                    stats = await self.db.get_user_stats(user.id)
                     payouts_text = Messages.get_payouts_text(stats)
                     await self.safe_edit_message(
                         query,
@@ -399,7 +556,7 @@ class PartnerBot:
 
                 # Обработка выплат
                 elif query.data == "request_payout" and db_user and db_user.signed_agreement:
-                    stats = self.db.get_user_stats(user.id)
+                    stats = await self.db.get_user_stats(user.id)
                     if stats['available_balance'] < Config.MIN_PAYOUT:
                         await self.safe_edit_message(
                             query,
@@ -414,29 +571,31 @@ class PartnerBot:
                             get_payment_methods_keyboard()
                         )
 
-                elif query.data == "payout_history" and db_user and db_user.signed_agreement:
-                    payouts = self.db.get_user_payouts(user.id)
-                    if not payouts:
-                        history_text = "*📋 История выплат*\n\nЗаявки на выплаты отсутствуют."
+                elif (query.data == "payout_history" or query.data.startswith("history_")) \
+                        and db_user and db_user.signed_agreement:
+                    # history_next_<id> - более старые заявки, history_prev_<id> - более новые
+                    after_id = before_id = None
+                    if query.data.startswith("history_next_"):
+                        after_id = int(query.data.replace("history_next_", ""))
+                    elif query.data.startswith("history_prev_"):
+                        before_id = int(query.data.replace("history_prev_", ""))
+                    payouts, has_more = await self.db.get_user_payouts_page(
+                        user.id, after_id, before_id, Config.PAYOUT_HISTORY_PAGE_SIZE
+                    )
+                    if not payouts and (after_id or before_id):
+                        after_id = before_id = None
+                        payouts, has_more = await self.db.get_user_payouts_page(
+                            user.id, limit=Config.PAYOUT_HISTORY_PAGE_SIZE
+                        )
+                    if before_id:
+                        has_prev, has_next = has_more, True
                     else:
-                        history_text = "*📋 История выплат*\n\n"
-                        for payout in payouts:
-                            status_icons = {
-                                'pending': '🟡',
-                                'approved': '✅',
-                                'rejected': '❌',
-                                'paid': '💰'
-                            }
-                            history_text += f"{status_icons.get(payout.status, '⚪')} *{payout.amount} руб.* - {payout.status}\n"
-                            history_text += f"*Дата:* {payout.requested_at.strftime('%d.%m.%Y %H:%M')}\n"
-                            if payout.processed_at:
-                                history_text += f"*Обработано:* {payout.processed_at.strftime('%d.%m.%Y %H:%M')}\n"
-                            history_text += "\n"
+                        has_prev, has_next = after_id is not None, has_more
 
                     await self.safe_edit_message(
                         query,
-                        history_text,
-                        get_back_keyboard("back_to_payouts")
+                        Messages.get_payout_history_text(payouts),
+                        get_payout_history_keyboard(payouts, has_prev, has_next)
                     )
 
                 elif query.data.startswith("method_") and db_user and db_user.signed_agreement:
@@ -459,54 +618,83 @@ class PartnerBot:
                     )
 
                 elif query.data == "admin_stats" and user.id == Config.ADMIN_ID:
-                    total_users = self.db.session.scalar(select(func.count(User.id))) or 0
-                    signed_users = self.db.session.scalar(
-                        select(func.count(User.id)).where(User.signed_agreement == True)) or 0
-                    total_referrals = self.db.session.scalar(select(func.count(Referral.id))) or 0
-
-                    pending_payouts_stmt = select(func.sum(Payout.amount)).where(Payout.status == 'pending')
-                    pending_payouts = self.db.session.scalar(pending_payouts_stmt) or 0
-
-                    stats_text = Messages.get_admin_stats_text(total_users, signed_users, total_referrals,
-                                                               pending_payouts)
+                    # Чтение готового снимка; пересчитывает его задача refresh_dashboard
+                    dashboard, history = await self.db.get_dashboard(Config.DASHBOARD_HISTORY_DAYS)
+                    if dashboard.refreshed_at is None:
+                        # Задача ещё не отработала (первый запуск)
+                        await self.db.refresh_dashboard()
+                        dashboard, history = await self.db.get_dashboard(Config.DASHBOARD_HISTORY_DAYS)
+                    stats_text = Messages.get_admin_stats_text(
+                        dashboard.total_users,
+                        dashboard.signed_users,
+                        dashboard.total_referrals,
+                        dashboard.pending_payouts,
+                        history,
+                        dashboard.refreshed_at
+                    )
                     await self.safe_edit_message(
                         query,
                         stats_text,
                         get_admin_keyboard()
                     )
 
-                elif query.data == "payout_requests" and user.id == Config.ADMIN_ID:
-                    pending_payouts = self.db.get_pending_payouts()
-                    if not pending_payouts:
-                        await self.safe_edit_message(
-                            query,
-                            "💰 *Заявки на выплаты*\n\nНет ожидающих заявок на выплаты.",
-                            get_admin_keyboard()
-                        )
+                elif (query.data == "payout_requests" or query.data.startswith("payouts_")) \
+                        and user.id == Config.ADMIN_ID:
+                    # payouts_next_<id> / payouts_prev_<id> - страницы после / перед заявкой
+                    after_id = before_id = None
+                    if query.data.startswith("payouts_next_"):
+                        after_id = int(query.data.replace("payouts_next_", ""))
+                    elif query.data.startswith("payouts_prev_"):
+                        before_id = int(query.data.replace("payouts_prev_", ""))
+                    rows, has_more = await self.db.get_pending_payouts_page(
+                        after_id, before_id, Config.PAYOUTS_PAGE_SIZE
+                    )
+                    if not rows and (after_id or before_id):
+                        # Заявки с соседних страниц уже обработаны - показываем начало очереди
+                        after_id = before_id = None
+                        rows, has_more = await self.db.get_pending_payouts_page(limit=Config.PAYOUTS_PAGE_SIZE)
+                    if before_id:
+                        has_prev, has_next = has_more, True
                     else:
-                        payout_text = "💰 *Заявки на выплаты*\n\n"
-                        for payout in pending_payouts:
-                            payout_user = self.db.get_user(payout.user_id)
-                            username = f"@{payout_user.username}" if payout_user.username else payout_user.first_name
-                            payout_text += f"*#{payout.id}* - {payout.amount} руб.\n"
-                            payout_text += f"*Пользователь:* {username}\n"
-                            payout_text += f"*Метод:* {payout.payment_method}\n"
-                            payout_text += f"*Дата:* {payout.requested_at.strftime('%d.%m.%Y %H:%M')}\n"
-                            payout_text += f"*Реквизиты:* {payout.details}\n\n"
+                        has_prev, has_next = after_id is not None, has_more
+                    payouts = [payout for payout, _, _ in rows]
+                    await self.safe_edit_message(
+                        query,
+                        Messages.get_payout_queue_text(rows),
+                        get_payout_queue_keyboard(payouts, has_prev, has_next, Config.BULK_APPROVE_MAX_AMOUNT)
+                        if rows else get_admin_keyboard()
+                    )
 
+                # Массовая обработка: bulk_<status>_page_<первая>_<последняя заявка>,
+                # bulk_<status>_under_<сумма>, bulk_<status>_confirm_<сумма>
+                elif query.data.startswith("bulk_") and user.id == Config.ADMIN_ID:
+                    _, status, action, *args = query.data.split("_")
+                    if status not in ('approved', 'rejected'):
+                        return
+                    if action == "page":
+                        # Границы страницы - из кнопки того сообщения, которое видит админ
+                        changed = await self.db.moderate_payouts(status, page=(int(args[0]), int(args[1])))
+                        await self.finish_bulk_moderation(query, context, status, changed)
+                    elif action == "under":
+                        max_amount = int(args[0])
+                        count, total = await self.db.get_pending_payouts_summary(max_amount)
                         await self.safe_edit_message(
                             query,
-                            payout_text,
-                            get_admin_keyboard()
+                            Messages.get_bulk_moderation_confirm_text(status, count, total, max_amount),
+                            get_bulk_moderation_keyboard(status, max_amount) if count
+                            else get_back_keyboard("payout_requests")
                         )
+                    elif action == "confirm":
+                        changed = await self.db.moderate_payouts(status, max_amount=int(args[0]))
+                        await self.finish_bulk_moderation(query, context, status, changed)
 
                 elif query.data.startswith("approve_") and user.id == Config.ADMIN_ID:
                     payout_id = int(query.data.replace("approve_", ""))
-                    payout = self.db.update_payout_status(payout_id, "approved")
+                    payout = await self.db.update_payout_status(payout_id, "approved")
                     if payout:
                         # Уведомляем пользователя
                         try:
-                            payout_user = self.db.get_user(payout.user_id)
+                            payout_user = await self.db.get_user(payout.user_id)
                             await context.bot.send_message(
                                 chat_id=payout_user.user_id,
                                 text=f"✅ Ваша заявка на выплату #{payout.id} на сумму {payout.amount} руб. одобрена!\n\n"
@@ -518,16 +706,16 @@ class PartnerBot:
                         await self.safe_edit_message(
                             query,
                             f"✅ Заявка #{payout_id} одобрена! Пользователь уведомлен.",
-                            get_admin_keyboard()
+                            get_back_keyboard("payout_requests")
                         )
 
                 elif query.data.startswith("reject_") and user.id == Config.ADMIN_ID:
                     payout_id = int(query.data.replace("reject_", ""))
-                    payout = self.db.update_payout_status(payout_id, "rejected")
+                    payout = await self.db.update_payout_status(payout_id, "rejected")
                     if payout:
                         # Уведомляем пользователя
                         try:
-                            payout_user = self.db.get_user(payout.user_id)
+                            payout_user = await self.db.get_user(payout.user_id)
                             await context.bot.send_message(
                                 chat_id=payout_user.user_id,
                                 text=f"❌ Ваша заявка на выплату #{payout.id} на сумму {payout.amount} руб. отклонена.\n\n"
@@ -539,21 +727,20 @@ class PartnerBot:
                         await self.safe_edit_message(
                             query,
                             f"❌ Заявка #{payout_id} отклонена! Пользователь уведомлен.",
-                            get_admin_keyboard()
+                            get_back_keyboard("payout_requests")
                         )
 
                 # Рассылка - Выбор получателей
                 elif query.data == "broadcast_recipients" and user.id == Config.ADMIN_ID:
-                    users_all = self.db.get_all_users()
-                    users_signed = self.db.get_all_users(signed_only=True)
-                    users_unsigned = self.db.get_all_users(signed_only=False)
+                    counts = await self.db.get_audience_counts()
 
                     recipients_text = f"""*👥 Выбор получателей*
 
     *Статистика аудиторий:*
-    • 👥 Все пользователи: {len(users_all)} чел.
-    • ✅ Подписавшие соглашение: {len(users_signed)} чел.
-    • ❌ Неподписавшие: {len(users_unsigned)} чел.
+    • 👥 Все пользователи: {counts['audience_all']} чел.
+    • ✅ Подписавшие соглашение: {counts['audience_signed']} чел.
+    • ❌ Неподписавшие: {counts['audience_unsigned']} чел.
+    • 🚫 Заблокировали бота (не получат рассылку): {counts['blocked_users']} чел.
 
     Выберите аудиторию для рассылки:"""
 
@@ -571,14 +758,9 @@ class PartnerBot:
                     self.broadcast_data['recipients'] = recipients_type
 
                     # Получаем количество пользователей выбранного типа
-                    if recipients_type == 'all':
-                        users = self.db.get_all_users()
-                    elif recipients_type == 'signed':
-                        users = self.db.get_all_users(signed_only=True)
-                    else:
-                        users = self.db.get_all_users(signed_only=False)
-
-                    self.broadcast_data['users_count'] = len(users)
+                    counts = await self.db.get_audience_counts()
+                    users_count = counts[AUDIENCE_COUNT_KEYS[recipients_type]]
+                    self.broadcast_data['users_count'] = users_count
 
                     recipients_names = {
                         'all': '👥 Все пользователи',
@@ -589,7 +771,7 @@ class PartnerBot:
                     await self.safe_edit_message(
                         query,
                         f"✅ Выбраны получатели: *{recipients_names[recipients_type]}*\n\n"
-                        f"*Количество:* {len(users)} пользователей\n\n"
+                        f"*Количество:* {users_count} пользователей\n\n"
                         f"Теперь установите текст рассылки или начните отправку.",
                         get_broadcast_keyboard()
                     )
@@ -629,98 +811,38 @@ class PartnerBot:
                 elif query.data == "broadcast_confirm" and user.id == Config.ADMIN_ID:
                     print("🚀 Начало рассылки...")
 
-                    # Получаем список пользователей
-                    if self.broadcast_data['recipients'] == 'all':
-                        users = self.db.get_all_users()
-                    elif self.broadcast_data['recipients'] == 'signed':
-                        users = self.db.get_all_users(signed_only=True)
-                    else:
-                        users = self.db.get_all_users(signed_only=False)
-
-                    print(f"📊 Найдено пользователей: {len(users)}")
-
-                    if len(users) == 0:
-                        await self.safe_edit_message(
-                            query,
-                            "❌ Нет пользователей для рассылки!",
-                            get_broadcast_keyboard()
-                        )
-                        return
-
-                    sent_count = 0
-                    failed_count = 0
-                    total_users = len(users)
-
                     # Создаем сообщение о начале рассылки
                     start_message = await query.message.reply_text(
                         f"🚀 *Начинаем рассылку...*\n\n"
-                        f"*Получателей:* {total_users}\n"
-                        f"*Тип:* {self.broadcast_data['recipients']}\n"
-                        f"*Прогресс:* 0/{total_users} (0%)"
+                        f"*Тип:* {self.broadcast_data['recipients']}"
                     )
 
-                    # Отправляем рассылку
-                    for index, user_obj in enumerate(users):
-                        try:
-                            print(f"📨 Отправка {index + 1}/{total_users} пользователю {user_obj.user_id}")
-
-                            success = await self.send_broadcast_message(
-                                context,
-                                user_obj.user_id,
-                                self.broadcast_data['text']
-                            )
-
-                            if success:
-                                sent_count += 1
-                                print(f"   ✅ Успешно")
-                            else:
-                                failed_count += 1
-                                print(f"   ❌ Ошибка")
-
-                            # Обновляем прогресс каждые 5 сообщений или для последнего
-                            if (index + 1) % 5 == 0 or (index + 1) == total_users:
-                                progress = (sent_count + failed_count) / total_users * 100
-                                try:
-                                    await context.bot.edit_message_text(
-                                        chat_id=start_message.chat_id,
-                                        message_id=start_message.message_id,
-                                        text=f"📤 *Идет рассылка...*\n\n"
-                                             f"*Получателей:* {total_users}\n"
-                                             f"*Отправлено:* {sent_count + failed_count}/{total_users}\n"
-                                             f"*Успешно:* {sent_count}\n"
-                                             f"*Ошибок:* {failed_count}\n"
-                                             f"*Прогресс:* {progress:.1f}%"
-                                    )
-                                except Exception as e:
-                                    print(f"Ошибка обновления прогресса: {e}")
-
-                            # Задержка
-                            await asyncio.sleep(Config.BROADCAST_DELAY)
-
-                        except Exception as e:
-                            print(f"❌ Критическая ошибка при отправке пользователю {user_obj.user_id}: {e}")
-                            failed_count += 1
-
-                    # Финальный результат
-                    print(f"✅ Рассылка завершена. Успешно: {sent_count}, Ошибок: {failed_count}")
-
-                    # Сохраняем статистику
-                    self.db.save_admin_message(user.id, self.broadcast_data['text'], sent_count)
+                    # Задание и список получателей сохраняются в БД одним INSERT ... SELECT
+                    # (пользователи не загружаются в память), отправка идёт в фоне
+                    # и продолжится после перезапуска бота
+                    job = await self.db.create_broadcast_job(
+                        user.id,
+                        self.broadcast_data['text'],
+                        self.broadcast_data['recipients'],
+                        start_message.chat_id,
+                        start_message.message_id
+                    )
+                    if not job:
+                        await query.message.reply_text("❌ Не удалось создать рассылку")
+                        return
 
-                    # Показываем результат
-                    result_text = f"""✅ *Рассылка завершена!*
+                    print(f"📊 Найдено пользователей: {job.total_count}")
 
-                📊 *Результаты:*
-                👥 Всего получателей: {total_users}
-                ✅ Успешно отправлено: {sent_count}
-                ❌ Ошибок доставки: {failed_count}
-                📈 Эффективность: {(sent_count / total_users * 100) if total_users > 0 else 0:.1f}%"""
+                    if job.total_count == 0:
+                        await self.db.finish_broadcast_job(job.id)
+                        await context.bot.edit_message_text(
+                            chat_id=start_message.chat_id,
+                            message_id=start_message.message_id,
+                            text="❌ Нет пользователей для рассылки!"
+                        )
+                        return
 
-                    await context.bot.edit_message_text(
-                        chat_id=start_message.chat_id,
-                        message_id=start_message.message_id,
-                        text=result_text
-                    )
+                    self.broadcast_dispatcher.start_job(context.bot, job)
 
                     # Сбрасываем данные
                     self.broadcast_data = {
@@ -750,6 +872,7 @@ class PartnerBot:
 
                     # Отладочная информация о состоянии рассылки
                 elif query.data == "debug_broadcast" and user.id == Config.ADMIN_ID:
+                    counts = await self.db.get_audience_counts()
                     debug_info = f"""*🐞 Отладочная информация рассылки*
 
                 *Текст:* {self.broadcast_data['text']}
@@ -757,9 +880,10 @@ class PartnerBot:
                 *Количество:* {self.broadcast_data['users_count']}
 
                 *Статистика пользователей:*
-                • Всего: {len(self.db.get_all_users())}
-                • Подписавшие: {len(self.db.get_all_users(signed_only=True))}
-                • Неподписавшие: {len(self.db.get_all_users(signed_only=False))}"""
+                • Всего: {counts['total_users']}
+                • Подписавшие: {counts['signed_users']}
+                • Неподписавшие: {counts['unsigned_users']}
+                • Заблокировали бота: {counts['blocked_users']}"""
 
                     await self.safe_edit_message(
                         query,
@@ -779,37 +903,20 @@ class PartnerBot:
             self.broadcast_data['text'] = text
             context.user_data.pop('awaiting_broadcast_text', None)
 
-            if self.broadcast_data['recipients'] == 'all':
-                users = self.db.get_all_users()
-            elif self.broadcast_data['recipients'] == 'signed':
-                users = self.db.get_all_users(signed_only=True)
-            else:
-                users = self.db.get_all_users(signed_only=False)
+            counts = await self.db.get_audience_counts()
+            users_count = counts[AUDIENCE_COUNT_KEYS[self.broadcast_data['recipients']]]
+            self.broadcast_data['users_count'] = users_count
 
-            self.broadcast_data['users_count'] = len(users)
-
-            print(f"👥 Получателей: {len(users)}")
+            print(f"👥 Получателей: {users_count}")
 
             await update.message.reply_text(
                 f"✅ Текст рассылки сохранен!\n\n"
                 f"Получатели: {self.broadcast_data['recipients']}\n"
-                f"Количество: {len(users)} пользователей\n\n"
+                f"Количество: {users_count} пользователей\n\n"
                 f"Теперь вы можете начать рассылку.",
                 reply_markup=get_broadcast_keyboard()
             )
 
-    async def send_broadcast_message(self, context, user_id, message_text):
-        """Отправка сообщения пользователю с обработкой ошибок"""
-        try:
-            await context.bot.send_message(
-                chat_id=user_id,
-                text=self.broadcast_data['text'],
-            )
-            return True
-        except Exception as e:
-            logging.error(f"Ошибка отправки пользователю {user_id}: {e}")
-            return False
-
 def main():
     if not Config.BOT_TOKEN or Config.BOT_TOKEN == 'your_telegram_bot_token':
         print("❌ Ошибка: BOT_TOKEN не настроен!")
@@ -827,14 +934,18 @@ def main():
         print("Укажите ваш Telegram ID в .env файле")
         return
 
+    if Config.WEBHOOK_URL and not Config.WEBHOOK_SECRET:
+        print("❌ Ошибка: для режима webhook нужен WEBHOOK_SECRET!")
+        print("Укажите в .env случайную строку (A-Z, a-z, 0-9, _ и -, до 256 символов)")
+        return
+
     try:
         bot = PartnerBot(Config.BOT_TOKEN)
         print("🤖 Бот инициализирован...")
         print("✅ Все функции реализованы")
         print("🔗 Запускаем бота...")
 
-        # Простой запуск без сложных retry-механизмов
-        bot.application.run_polling()
+        bot.run()
 
     except Exception as e:
         print(f"❌ Критическая ошибка: {e}")
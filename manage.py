@@ -0,0 +1,45 @@
+"""Служебные команды: python manage.py <команда>"""
+import argparse
+import asyncio
+
+from config import Config
+from database import Database
+
+
+async def migrate(db):
+    await db.init()
+    print("✅ Схема базы данных обновлена")
+
+
+async def rebuild_stats(db):
+    await db.init()
+    await db.rebuild_partner_stats()
+    await db.rebuild_referral_tree()
+    print("✅ Статистика партнёров и дерево рефералов пересчитаны")
+
+
+COMMANDS = {
+    'migrate': (migrate, "Создать недостающие таблицы и применить миграции"),
+    'rebuild-stats': (rebuild_stats, "Пересчитать partner_stats и дерево рефералов из рефералов и выплат"),
+}
+
+
+async def run(command):
+    db = Database(Config.DATABASE_URL)
+    try:
+        await COMMANDS[command][0](db)
+    finally:
+        await db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Служебные команды партнёрского бота")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    for name, (_, help_text) in COMMANDS.items():
+        subparsers.add_parser(name, help=help_text)
+    args = parser.parse_args()
+    asyncio.run(run(args.command))
+
+
+if __name__ == '__main__':
+    main()
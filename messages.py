@@ -48,12 +48,18 @@ class Messages:
 
     @staticmethod
     def get_stats_text(stats, ref_link):
+        levels = ''.join(
+            f"\n{depth}-й уровень: {total} (подтверждено {confirmed})"
+            for depth, total, confirmed in stats.get('levels', [])
+        )
+        if levels:
+            levels = "\n\n🌳 Ваша структура:" + levels
         return f"""📊 Ваша статистика
 
 👥 Всего привлечено: {stats['total']}
 ✅ Подтверждено: {stats['confirmed']} 
 🟡 Ожидают: {stats['pending']}
-🔥 Активных: {stats['active']}
+🔥 Активных: {stats['active']}{levels}
 
 💰 Финансы:
 💵 Общий доход: {stats['total_income']} руб.
@@ -129,15 +135,108 @@ class Messages:
 Статус выплаты можно отслеживать в разделе "История выплат" """
 
     @staticmethod
-    def get_admin_stats_text(total_users, signed_users, total_referrals, pending_payouts):
+    def get_payouts_moderated_text(status, payouts):
+        """Уведомление партнёру о массово обработанных заявках: payouts - [(payout_id, amount)]"""
+        if len(payouts) == 1:
+            payout_id, amount = payouts[0]
+            if status == 'approved':
+                return (f"✅ Ваша заявка на выплату #{payout_id} на сумму {amount} руб. одобрена!\n\n"
+                        f"Ожидайте поступления средств в течение 1-3 рабочих дней.")
+            return (f"❌ Ваша заявка на выплату #{payout_id} на сумму {amount} руб. отклонена.\n\n"
+                    f"По вопросам обращайтесь в поддержку.")
+        lines = '\n'.join(f"#{payout_id} - {amount} руб." for payout_id, amount in payouts)
+        if status == 'approved':
+            return (f"✅ Ваши заявки на выплату одобрены:\n{lines}\n\n"
+                    f"Ожидайте поступления средств в течение 1-3 рабочих дней.")
+        return f"❌ Ваши заявки на выплату отклонены:\n{lines}\n\nПо вопросам обращайтесь в поддержку."
+
+    @staticmethod
+    def get_bulk_moderation_confirm_text(status, count, total, max_amount):
+        action = "Одобрить" if status == 'approved' else "Отклонить"
+        return f"""💰 Массовая обработка заявок
+
+{action} все ожидающие заявки до {max_amount} руб.?
+
+📋 Заявок: {count}
+💵 На сумму: {total} руб."""
+
+    @staticmethod
+    def get_bulk_moderation_result_text(status, count, total):
+        if not count:
+            return "💰 Нет ожидающих заявок для обработки - возможно, они уже обработаны."
+        action = "✅ Одобрено" if status == 'approved' else "❌ Отклонено"
+        return f"""{action} заявок: {count} на сумму {total} руб.
+
+Партнёры получат уведомления в течение нескольких минут."""
+
+    @staticmethod
+    def get_payout_history_text(payouts):
+        if not payouts:
+            return "*📋 История выплат*\n\nЗаявки на выплаты отсутствуют."
+        status_icons = {
+            'pending': '🟡',
+            'approved': '✅',
+            'rejected': '❌',
+            'paid': '💰'
+        }
+        history_text = "*📋 История выплат*\n\n"
+        for payout in payouts:
+            history_text += f"{status_icons.get(payout.status, '⚪')} *{payout.amount} руб.* - {payout.status}\n"
+            history_text += f"*Дата:* {payout.requested_at.strftime('%d.%m.%Y %H:%M')}\n"
+            if payout.processed_at:
+                history_text += f"*Обработано:* {payout.processed_at.strftime('%d.%m.%Y %H:%M')}\n"
+            history_text += "\n"
+        return history_text
+
+    @staticmethod
+    def get_referral_digest_text(names, minutes):
+        """Уведомление рефереру: один новый партнёр или сводка за minutes минут"""
+        if len(names) == 1:
+            return f"🎉 По вашей ссылке зарегистрировался новый партнёр: {names[0]}"
+        shown = ', '.join(name or 'без имени' for name in names[:5])
+        rest = f" и ещё {len(names) - 5}" if len(names) > 5 else ""
+        return f"""🎉 +{len(names)} новых партнёров по вашей ссылке за последние {minutes} мин.
+
+Среди них: {shown}{rest}"""
+
+    @staticmethod
+    def get_admin_stats_text(total_users, signed_users, total_referrals, pending_payouts,
+                             history=(), refreshed_at=None):
         conversion = (signed_users / total_users * 100) if total_users > 0 else 0
-        return f"""📈 Общая статистика
+        text = f"""📈 Общая статистика
 
 👥 Всего пользователей: {total_users}
 ✅ Подписали соглашение: {signed_users}
 📊 Конверсия: {conversion:.1f}%
 🔗 Всего рефералов: {total_referrals}
 💰 Ожидает выплат: {pending_payouts} руб."""
+        if history:
+            text += "\n\n📅 По дням (регистрации / подписали / подтверждено / выплачено):"
+            for day in history:
+                text += (f"\n{day.day[8:10]}.{day.day[5:7]}: {day.signups} / {day.signed} / "
+                         f"{day.confirmed_referrals} / {day.payouts_paid:g} руб.")
+        if refreshed_at:
+            text += f"\n\n🕒 Обновлено: {refreshed_at.strftime('%d.%m %H:%M')}"
+        return text
+
+    @staticmethod
+    def get_payout_queue_text(rows):
+        """rows - [(Payout, username, first_name)] одной страницы очереди"""
+        if not rows:
+            return "💰 *Заявки на выплаты*\n\nНет ожидающих заявок на выплаты."
+        payout_text = "💰 *Заявки на выплаты*\n\n"
+        for payout, username, first_name in rows:
+            name = f"@{username}" if username else (first_name or payout.user_id)
+            details = payout.details or ''
+            # Реквизиты вводит партнёр - длинный текст не должен раздувать страницу
+            if len(details) > Config.PAYOUT_DETAILS_PREVIEW:
+                details = details[:Config.PAYOUT_DETAILS_PREVIEW] + "…"
+            payout_text += f"*#{payout.id}* - {payout.amount} руб.\n"
+            payout_text += f"*Пользователь:* {name}\n"
+            payout_text += f"*Метод:* {payout.payment_method}\n"
+            payout_text += f"*Дата:* {payout.requested_at.strftime('%d.%m.%Y %H:%M')}\n"
+            payout_text += f"*Реквизиты:* {details}\n\n"
+        return payout_text
 
     @staticmethod
     def get_broadcast_start_text():
@@ -0,0 +1,282 @@
+"""Метрики бота в текстовом формате Prometheus.
+
+Счётчики и гистограммы живут в памяти процесса и обновляются из event loop
+бота; тот же loop отдаёт их по HTTP (GET /metrics), поэтому блокировки не нужны.
+Включается через METRICS_PORT в .env.
+"""
+import asyncio
+import logging
+import re
+import time
+from collections import defaultdict
+
+from sqlalchemy import event
+from telegram.request import HTTPXRequest
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = defaultdict(int)
+
+    def inc(self, *labels, amount=1):
+        self._values[labels] += amount
+
+    def collect(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} counter"
+        for labels, value in sorted(self._values.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets) + (float('inf'),)
+        # labels -> [счётчики по бакетам (не накопительные), сумма, количество]
+        self._values = {}
+
+    def observe(self, value, *labels):
+        entry = self._values.get(labels)
+        if entry is None:
+            entry = self._values[labels] = [[0] * len(self.buckets), 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                entry[0][i] += 1
+                break
+        entry[1] += value
+        entry[2] += 1
+
+    def collect(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} histogram"
+        for labels, (counts, total, count) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(bound)}"'
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(total)}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, labels)} {count}"
+
+
+class Gauge:
+    """Значение вычисляется в момент чтения: callback возвращает {labels: value}"""
+
+    def __init__(self, name, documentation, labelnames=(), callback=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.callback = callback
+
+    def collect(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} gauge"
+        if not self.callback:
+            return
+        try:
+            values = self.callback()
+        except Exception as e:
+            logging.error(f"Ошибка расчёта метрики {self.name}: {e}")
+            return
+        for labels, value in sorted(values.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+
+
+UPDATE_LATENCY = Histogram(
+    'partner_bot_update_duration_seconds', "Время обработки апдейта", ['route'])
+UPDATE_QUEUE_WAIT = Histogram(
+    'partner_bot_update_queue_seconds', "Ожидание апдейта в очереди своего пользователя и общего лимита")
+DB_QUERIES = Histogram(
+    'partner_bot_db_query_duration_seconds', "Время SQL-запросов", ['operation', 'table'], DB_BUCKETS)
+DB_ERRORS = Counter(
+    'partner_bot_db_errors_total', "Ошибки SQL-запросов", ['operation', 'table'])
+TELEGRAM_API_LATENCY = Histogram(
+    'partner_bot_telegram_api_duration_seconds', "Время вызовов Bot API", ['method'])
+TELEGRAM_API_ERRORS = Counter(
+    'partner_bot_telegram_api_errors_total', "Ошибки вызовов Bot API", ['method', 'error'])
+BROADCAST_DELIVERIES = Counter(
+    'partner_bot_broadcast_deliveries_total', "Результаты доставки рассылок", ['status'])
+BROADCAST_QUEUED = Gauge(
+    'partner_bot_broadcast_queued', "Получатели в очереди активных рассылок")
+BROADCAST_SENT = Gauge(
+    'partner_bot_broadcast_sent', "Отправлено в активных рассылках", ['job_id'])
+BROADCAST_FAILED = Gauge(
+    'partner_bot_broadcast_failed', "Ошибок в активных рассылках", ['job_id'])
+BROADCAST_RATE = Gauge(
+    'partner_bot_broadcast_rate', "Скорость активных рассылок, сообщений в секунду", ['job_id'])
+
+REGISTRY = [
+    UPDATE_LATENCY, UPDATE_QUEUE_WAIT, DB_QUERIES, DB_ERRORS, TELEGRAM_API_LATENCY,
+    TELEGRAM_API_ERRORS, BROADCAST_DELIVERIES, BROADCAST_QUEUED, BROADCAST_SENT,
+    BROADCAST_FAILED, BROADCAST_RATE
+]
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.collect())
+    return '\n'.join(lines) + '\n'
+
+
+_COMMAND_RE = re.compile(r'^/([A-Za-z0-9_]{1,32})(@\w+)?$')
+
+# Метки - только из известных команд и callback_data: текст и callback_data приходят
+# от пользователя, и каждая новая метка - это навсегда новая серия гистограммы
+COMMANDS = frozenset(('start', 'stats', 'payout', 'admin', 'debug'))
+CALLBACKS = frozenset((
+    'about', 'partnership_info', 'sign_agreement', 'confirm_agreement', 'cancel_agreement',
+    'stats', 'referral_link', 'documents', 'payouts', 'support', 'back_to_main',
+    'back_to_payouts', 'back_to_admin', 'request_payout', 'payout_history',
+    'method_card', 'method_qiwi', 'method_yoomoney', 'broadcast', 'admin_stats',
+    'payout_requests', 'broadcast_text', 'broadcast_recipients', 'broadcast_start',
+    'broadcast_confirm', 'broadcast_cancel', 'recipients_all', 'recipients_signed',
+    'recipients_unsigned', 'debug_broadcast',
+))
+# callback_data с id или суммой в конце: approve_15 -> approve_{id}
+CALLBACK_PREFIXES = (
+    'approve_', 'reject_', 'payouts_next_', 'payouts_prev_', 'history_next_', 'history_prev_',
+    'bulk_approved_page_', 'bulk_rejected_page_', 'bulk_approved_under_', 'bulk_rejected_under_',
+    'bulk_approved_confirm_', 'bulk_rejected_confirm_',
+)
+
+
+def update_route(update):
+    """Метка обработчика: command:/start, callback:approve_{id}, message"""
+    query = getattr(update, 'callback_query', None)
+    if query:
+        data = query.data or ''
+        if data in CALLBACKS:
+            return f"callback:{data}"
+        for prefix in CALLBACK_PREFIXES:
+            if data.startswith(prefix):
+                return f"callback:{prefix}{{id}}"
+        return 'callback:other'
+    message = getattr(update, 'effective_message', None)
+    if message is None:
+        return 'other'
+    text = message.text or ''
+    if text.startswith('/'):
+        match = _COMMAND_RE.match(text.split()[0])
+        command = match.group(1).lower() if match else None
+        return f"command:/{command}" if command in COMMANDS else 'command:other'
+    return 'message'
+
+
+def track_broadcasts(dispatcher):
+    """Гейджи рассылок читают состояние BroadcastEngine активных заданий"""
+    def engines():
+        return list(dispatcher.engines.items())
+
+    def rate(engine):
+        elapsed = time.monotonic() - engine.started_at if engine.started_at else 0
+        return engine.sent / elapsed if elapsed > 0 else 0
+
+    BROADCAST_QUEUED.callback = lambda: {(): sum(engine.queued for _, engine in engines())}
+    BROADCAST_SENT.callback = lambda: {(job_id,): engine.sent for job_id, engine in engines()}
+    BROADCAST_FAILED.callback = lambda: {(job_id,): engine.failed for job_id, engine in engines()}
+    BROADCAST_RATE.callback = lambda: {(job_id,): rate(engine) for job_id, engine in engines()}
+
+
+_TABLE_RE = re.compile(r'\b(?:FROM|INTO|UPDATE|TABLE)\s+"?(\w+)', re.IGNORECASE)
+
+
+def _query_labels(statement):
+    operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else 'OTHER'
+    match = _TABLE_RE.search(statement)
+    return operation, match.group(1) if match else ''
+
+
+def instrument_engine(engine):
+    """Время и ошибки SQL-запросов по операции и таблице (AsyncEngine или Engine)"""
+    sync_engine = getattr(engine, 'sync_engine', engine)
+
+    @event.listens_for(sync_engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('metrics_query_start', []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info['metrics_query_start'].pop()
+        DB_QUERIES.observe(time.perf_counter() - started, *_query_labels(statement))
+
+    @event.listens_for(sync_engine, 'handle_error')
+    def handle_error(context):
+        starts = context.connection.info.get('metrics_query_start') if context.connection else None
+        if starts:
+            starts.pop()
+        DB_ERRORS.inc(*_query_labels(context.statement or ''))
+
+
+class MetricsRequest(HTTPXRequest):
+    """HTTPXRequest, который замеряет время и ошибки каждого вызова Bot API"""
+
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        api_method = url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, request_data, *args, **kwargs)
+        except Exception as e:
+            TELEGRAM_API_ERRORS.inc(api_method, type(e).__name__)
+            raise
+        finally:
+            TELEGRAM_API_LATENCY.observe(time.perf_counter() - started, api_method)
+        if code >= 400:
+            TELEGRAM_API_ERRORS.inc(api_method, str(code))
+        return code, payload
+
+
+async def _handle_http(reader, writer):
+    try:
+        request_line = await reader.readline()
+        # Заголовки запроса не нужны, но их надо дочитать
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass
+        parts = request_line.decode('latin-1').split()
+        if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+            status, body = '200 OK', render().encode()
+        else:
+            status, body = '404 Not Found', b'Not Found\n'
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except Exception as e:
+        logging.warning(f"Ошибка ответа на запрос метрик: {e}")
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(host, port):
+    """Отдаёт /metrics из текущего event loop; возвращает asyncio.Server"""
+    server = await asyncio.start_server(_handle_http, host, port)
+    logging.info(f"Метрики: http://{host}:{port}/metrics")
+    return server
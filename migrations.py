@@ -0,0 +1,113 @@
+"""Версионные миграции схемы.
+
+Base.metadata.create_all создаёт только отсутствующие таблицы и не трогает
+существующие, поэтому изменения уже созданных таблиц (индексы, колонки)
+выполняются здесь. Каждая миграция выполняется один раз, номер последней
+применённой версии хранится в таблице schema_version.
+
+Чтобы изменить схему: добавьте функцию-шаг и допишите её в MIGRATIONS
+со следующим номером. Шаги должны быть идемпотентными - на новой базе
+create_all уже создал всё, что описано в моделях.
+"""
+import logging
+
+from sqlalchemy import Column, Integer, MetaData, Table, inspect, select
+
+_metadata = MetaData()
+
+schema_version = Table(
+    'schema_version', _metadata,
+    Column('version', Integer, nullable=False),
+)
+
+
+def add_column(connection, table, column_name, column_sql):
+    """ALTER TABLE ADD COLUMN, если колонки ещё нет (для шагов миграций)"""
+    columns = {column['name'] for column in inspect(connection).get_columns(table)}
+    if column_name not in columns:
+        connection.exec_driver_sql(f"ALTER TABLE {table} ADD COLUMN {column_name} {column_sql}")
+
+
+def _add_indexes(connection):
+    # Дубликаты рефералов мешают уникальному индексу - оставляем самую раннюю запись
+    connection.exec_driver_sql(
+        "DELETE FROM referrals WHERE id NOT IN "
+        "(SELECT MIN(id) FROM referrals GROUP BY referrer_id, referred_id)"
+    )
+    for statement in (
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_referrals_referrer_referred ON referrals (referrer_id, referred_id)",
+        "CREATE INDEX IF NOT EXISTS ix_referrals_referrer_confirmed ON referrals (referrer_id, confirmed)",
+        "CREATE INDEX IF NOT EXISTS ix_referrals_referred_id ON referrals (referred_id)",
+        "CREATE INDEX IF NOT EXISTS ix_payouts_user_status ON payouts (user_id, status)",
+        "CREATE INDEX IF NOT EXISTS ix_payouts_status_requested ON payouts (status, requested_at)",
+        "CREATE INDEX IF NOT EXISTS ix_users_signed_agreement ON users (signed_agreement)",
+    ):
+        connection.exec_driver_sql(statement)
+
+
+def _backfill_partner_stats(connection):
+    # Таблицу partner_stats уже создал create_all, заполняем её из истории
+    from database import rebuild_partner_stats
+    rebuild_partner_stats(connection)
+
+
+def _add_delivery_state(connection):
+    add_column(connection, 'users', 'blocked_at', 'DATETIME')
+    add_column(connection, 'users', 'last_delivery_error', 'TEXT')
+
+
+def _add_payout_history_index(connection):
+    connection.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_payouts_user_requested ON payouts (user_id, requested_at)"
+    )
+
+
+def _add_dashboard_indexes(connection):
+    # Даты событий для пересчёта daily_stats за последние дни
+    for statement in (
+        "CREATE INDEX IF NOT EXISTS ix_users_created_at ON users (created_at)",
+        "CREATE INDEX IF NOT EXISTS ix_users_signed_at ON users (signed_at)",
+        "CREATE INDEX IF NOT EXISTS ix_referrals_confirmed_at ON referrals (confirmed_at)",
+        "CREATE INDEX IF NOT EXISTS ix_payouts_requested_at ON payouts (requested_at)",
+        "CREATE INDEX IF NOT EXISTS ix_payouts_processed_at ON payouts (processed_at)",
+    ):
+        connection.exec_driver_sql(statement)
+
+
+def _backfill_referral_tree(connection):
+    # referral_paths и downline_stats уже созданы create_all, заполняем их из referrals
+    from database import rebuild_referral_tree
+    rebuild_referral_tree(connection)
+
+
+def _add_scheduled_message_markup(connection):
+    add_column(connection, 'scheduled_messages', 'reply_markup', 'TEXT')
+
+
+MIGRATIONS = [
+    (1, _add_indexes),
+    (2, _backfill_partner_stats),
+    (3, _add_delivery_state),
+    (4, _add_payout_history_index),
+    (5, _add_dashboard_indexes),
+    (6, _backfill_referral_tree),
+    (7, _add_scheduled_message_markup),
+]
+
+
+def get_version(connection):
+    _metadata.create_all(connection)
+    return connection.scalar(select(schema_version.c.version)) or 0
+
+
+def upgrade(connection):
+    """Применяет недостающие миграции. connection - синхронное соединение (AsyncConnection.run_sync)"""
+    current = get_version(connection)
+    for version, step in MIGRATIONS:
+        if version <= current:
+            continue
+        logging.info(f"Applying schema migration {version}: {step.__name__}")
+        step(connection)
+        connection.execute(schema_version.delete())
+        connection.execute(schema_version.insert().values(version=version))
+        current = version
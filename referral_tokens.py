@@ -0,0 +1,33 @@
+"""Подписанные реферальные токены: p_<user_id>_<подпись>.
+
+Подпись - усечённый HMAC-SHA256 от user_id, поэтому реферер определяется из
+самого токена без запроса к БД, а подделать токен для чужого id нельзя.
+Токен помещается в параметр /start (до 64 символов из A-Z, a-z, 0-9, _ и -).
+"""
+import base64
+import hashlib
+import hmac
+
+PREFIX = 'p_'
+SIGNATURE_BYTES = 9  # 12 символов base64url
+
+
+def _signature(user_id, secret):
+    digest = hmac.new(secret.encode(), f"referral:{user_id}".encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest[:SIGNATURE_BYTES]).decode()
+
+
+def make_referral_token(user_id, secret):
+    return f"{PREFIX}{user_id}_{_signature(user_id, secret)}"
+
+
+def parse_referral_token(token, secret):
+    """user_id реферера или None, если токен не наш или подпись не совпадает"""
+    if not token.startswith(PREFIX):
+        return None
+    user_id, _, signature = token[len(PREFIX):].partition('_')
+    if not user_id.isdigit() or not signature:
+        return None
+    if not hmac.compare_digest(signature, _signature(int(user_id), secret)):
+        return None
+    return int(user_id)
@@ -0,0 +1,68 @@
+"""Отправка записанных апдейтов Telegram в webhook бота (локальная проверка режима webhook).
+
+Примеры:
+    python replay_updates.py updates.json
+    python replay_updates.py updates.jsonl --url http://127.0.0.1:8443/telegram --delay 0.1
+
+Файл может содержать один апдейт, JSON-массив апдейтов или по одному апдейту
+в строке (JSON Lines). Адрес и секрет по умолчанию берутся из .env
+(WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET).
+"""
+import argparse
+import json
+import time
+
+import requests
+
+from config import Config
+
+
+def load_updates(path):
+    with open(path, encoding='utf-8') as f:
+        content = f.read().strip()
+    if not content:
+        return []
+    try:
+        data = json.loads(content)
+    except json.JSONDecodeError:
+        return [json.loads(line) for line in content.splitlines() if line.strip()]
+    return data if isinstance(data, list) else [data]
+
+
+def replay(updates, url, secret, delay=0.0):
+    session = requests.Session()
+    headers = {'X-Telegram-Bot-Api-Secret-Token': secret} if secret else {}
+    latencies = []
+    for update in updates:
+        started = time.perf_counter()
+        response = session.post(url, json=update, headers=headers, timeout=10)
+        latencies.append(time.perf_counter() - started)
+        status = "✅" if response.ok else "❌"
+        print(f"{status} update_id={update.get('update_id')} -> HTTP {response.status_code}")
+        if delay:
+            time.sleep(delay)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Отправка записанных апдейтов в webhook бота")
+    parser.add_argument('files', nargs='+', help="JSON / JSON Lines файлы с апдейтами")
+    parser.add_argument('--url', default=f"http://127.0.0.1:{Config.WEBHOOK_PORT}/{Config.WEBHOOK_PATH}")
+    parser.add_argument('--secret', default=Config.WEBHOOK_SECRET)
+    parser.add_argument('--delay', type=float, default=0.0, help="Пауза между апдейтами, секунды")
+    args = parser.parse_args()
+
+    updates = []
+    for path in args.files:
+        updates.extend(load_updates(path))
+
+    latencies = replay(updates, args.url, args.secret, args.delay)
+    if latencies:
+        latencies.sort()
+        print(f"\n📊 Отправлено: {len(latencies)}, "
+              f"медиана: {latencies[len(latencies) // 2] * 1000:.1f} мс, "
+              f"максимум: {latencies[-1] * 1000:.1f} мс")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+"""Профилирование SQL-запросов по апдейтам (включается SQL_PROFILE=1).
+
+Каждый обработанный апдейт получает свой профиль (через contextvar): сколько
+запросов выполнено, сколько времени они заняли и какие одинаковые по форме
+запросы повторялись. Повторы от repeat_threshold раз - признак N+1 (запрос в
+цикле), такие апдейты пишутся в лог сразу. Сводка худших маршрутов пишется
+каждые report_every апдейтов и при остановке бота.
+"""
+import logging
+import re
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from sqlalchemy import event
+
+_current_profile = ContextVar('sql_profile', default=None)
+
+# IN (?, ?, ?) с разным числом параметров - один и тот же запрос
+_IN_LIST_RE = re.compile(r'\(\s*(?:\?|%\(\w+\)s|\$\d+)(?:\s*,\s*(?:\?|%\(\w+\)s|\$\d+))*\s*\)')
+_SPACES_RE = re.compile(r'\s+')
+_SELECT_LIST_RE = re.compile(r'^SELECT .*? FROM ', re.IGNORECASE)
+
+
+def statement_shape(statement):
+    return _SPACES_RE.sub(' ', _IN_LIST_RE.sub('(?)', statement)).strip()
+
+
+def _short(shape, limit=200):
+    # Список колонок SELECT в логе не нужен - важны таблица и условие
+    return _SELECT_LIST_RE.sub('SELECT ... FROM ', shape)[:limit]
+
+
+class UpdateProfile:
+    def __init__(self, route):
+        self.route = route
+        self.active = True
+        self.queries = 0
+        self.duration = 0.0
+        self.shapes = defaultdict(lambda: [0, 0.0])  # форма запроса -> [количество, время]
+
+    def record(self, statement, duration):
+        self.queries += 1
+        self.duration += duration
+        entry = self.shapes[statement_shape(statement)]
+        entry[0] += 1
+        entry[1] += duration
+
+    def repeated(self, threshold):
+        """Формы запросов, выполненные не меньше threshold раз, самые частые первыми"""
+        return sorted(
+            ((shape, count, duration) for shape, (count, duration) in self.shapes.items() if count >= threshold),
+            key=lambda item: -item[1]
+        )
+
+
+class RouteStats:
+    def __init__(self):
+        self.updates = 0
+        self.queries = 0
+        self.max_queries = 0
+        self.duration = 0.0
+        self.flagged = 0
+        self.worst_repeat = None  # (форма, количество) для худшего повтора
+
+    def add(self, profile, repeated):
+        self.updates += 1
+        self.queries += profile.queries
+        self.max_queries = max(self.max_queries, profile.queries)
+        self.duration += profile.duration
+        if repeated:
+            self.flagged += 1
+            shape, count, _ = repeated[0]
+            if not self.worst_repeat or count > self.worst_repeat[1]:
+                self.worst_repeat = (shape, count)
+
+
+class SQLProfiler:
+    def __init__(self, repeat_threshold=3, report_every=500, top=10):
+        self.repeat_threshold = repeat_threshold
+        self.report_every = report_every
+        self.top = top
+        self.routes = defaultdict(RouteStats)
+        self._updates = 0
+
+    def instrument_engine(self, engine):
+        """Подписка на события движка (AsyncEngine или Engine)"""
+        sync_engine = getattr(engine, 'sync_engine', engine)
+
+        @event.listens_for(sync_engine, 'before_cursor_execute')
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            conn.info.setdefault('profiler_query_start', []).append(time.perf_counter())
+
+        @event.listens_for(sync_engine, 'after_cursor_execute')
+        def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            started = conn.info['profiler_query_start'].pop()
+            profile = _current_profile.get()
+            # Задачи, запущенные из обработчика (рассылка), наследуют контекст,
+            # но к апдейту после его завершения не относятся
+            if profile is not None and profile.active:
+                profile.record(statement, time.perf_counter() - started)
+
+        @event.listens_for(sync_engine, 'handle_error')
+        def handle_error(context):
+            starts = context.connection.info.get('profiler_query_start') if context.connection else None
+            if starts:
+                starts.pop()
+
+    @contextmanager
+    def profile(self, route):
+        profile = UpdateProfile(route)
+        token = _current_profile.set(profile)
+        try:
+            yield profile
+        finally:
+            profile.active = False
+            _current_profile.reset(token)
+            self._finish(profile)
+
+    def _finish(self, profile):
+        repeated = profile.repeated(self.repeat_threshold)
+        self.routes[profile.route].add(profile, repeated)
+        if repeated:
+            shape, count, duration = repeated[0]
+            logging.warning(
+                f"N+1 в {profile.route}: {profile.queries} запросов за {profile.duration * 1000:.1f} мс, "
+                f"повтор x{count} ({duration * 1000:.1f} мс): {_short(shape)}"
+            )
+        self._updates += 1
+        if self.report_every and self._updates % self.report_every == 0:
+            self.log_summary()
+
+    def summary(self):
+        """Маршруты, отсортированные по максимальному числу запросов на апдейт"""
+        return sorted(self.routes.items(), key=lambda item: (-item[1].max_queries, -item[1].queries))[:self.top]
+
+    def log_summary(self):
+        if not self.routes:
+            return
+        lines = ["Профиль SQL по маршрутам (макс. запросов на апдейт / среднее / среднее время / N+1):"]
+        for route, stats in self.summary():
+            line = (f"  {route}: {stats.max_queries} / {stats.queries / stats.updates:.1f} / "
+                    f"{stats.duration / stats.updates * 1000:.1f} мс / {stats.flagged} из {stats.updates}")
+            if stats.worst_repeat:
+                shape, count = stats.worst_repeat
+                line += f", худший повтор x{count}: {_short(shape, 120)}"
+            lines.append(line)
+        logging.info('\n'.join(lines))
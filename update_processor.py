@@ -0,0 +1,75 @@
+import asyncio
+import sys
+import time
+
+from telegram.ext import BaseUpdateProcessor
+
+import metrics
+
+
+class UserOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка апдейтов с сохранением порядка для каждого пользователя.
+
+    Апдейты разных пользователей обрабатываются одновременно (не более
+    max_concurrent_updates), а апдейты одного user_id - строго по очереди,
+    поэтому сценарии вроде awaiting_payout не могут гоняться сами с собой.
+    """
+
+    def __init__(self, max_concurrent_updates, profiler=None):
+        # Семафор базового класса берётся до do_process_update, т.е. до очереди
+        # пользователя, поэтому он отключён, а лимит держит свой семафор
+        super().__init__(sys.maxsize)
+        self._max_concurrent_updates = max_concurrent_updates
+        self._slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+        # SQLProfiler: считает запросы каждого апдейта (None - профилирование выключено)
+        self.profiler = profiler
+        # user_id -> [lock, число ожидающих апдейтов]
+        self._user_locks = {}
+
+    @staticmethod
+    def _get_key(update):
+        user = getattr(update, 'effective_user', None)
+        if user:
+            return user.id
+        chat = getattr(update, 'effective_chat', None)
+        return chat.id if chat else None
+
+    async def _timed(self, update, coroutine, enqueued):
+        started = time.perf_counter()
+        metrics.UPDATE_QUEUE_WAIT.observe(started - enqueued)
+        route = metrics.update_route(update)
+        try:
+            if self.profiler:
+                with self.profiler.profile(route):
+                    await coroutine
+            else:
+                await coroutine
+        finally:
+            metrics.UPDATE_LATENCY.observe(time.perf_counter() - started, route)
+
+    async def do_process_update(self, update, coroutine):
+        # Сначала очередь пользователя, потом общий слот: апдейты, ждущие своей
+        # очереди, не занимают слоты, и частые апдейты одного пользователя
+        # не задерживают остальных
+        coroutine = self._timed(update, coroutine, time.perf_counter())
+        key = self._get_key(update)
+        if key is None:
+            async with self._slots:
+                await coroutine
+            return
+
+        entry = self._user_locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0], self._slots:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._user_locks[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
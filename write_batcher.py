@@ -0,0 +1,103 @@
+"""Групповая фиксация записей (group commit).
+
+Записи, пришедшие в пределах max_delay секунд, выполняются одной транзакцией:
+один COMMIT (и один fsync на SQLite) на пачку вместо одного на строку. Каждая
+операция идёт в своей точке сохранения (SAVEPOINT), поэтому ошибка одной
+операции откатывает только её. Вызывающий получает результат своей операции
+только после COMMIT всей пачки.
+"""
+import asyncio
+import contextvars
+import logging
+
+from sqlalchemy import text
+
+
+class WriteBatcher:
+    def __init__(self, session_factory, max_batch=100, max_delay=0.01):
+        self.Session = session_factory
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._queue = None
+        self._task = None
+        self._closing = False
+
+    async def submit(self, op):
+        """Выполняет await op(session) в ближайшей пачке и возвращает его результат"""
+        if self._closing:
+            raise RuntimeError("WriteBatcher закрыт")
+        if self._task is None:
+            self._queue = asyncio.Queue()
+            # Фоновая задача не должна наследовать контекст первого обработчика (профиль SQL и т.п.)
+            self._task = contextvars.Context().run(asyncio.create_task, self._run())
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((op, future))
+        return await future
+
+    async def close(self):
+        """Дописывает уже принятые операции и останавливает фоновую задачу"""
+        self._closing = True
+        if self._task is None:
+            return
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+
+    async def _collect(self):
+        item = await self._queue.get()
+        if item is None:
+            return None, True
+        batch = [item]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_delay
+        while len(batch) < self.max_batch:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(self._queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    async def _run(self):
+        while True:
+            batch, stop = await self._collect()
+            if batch:
+                await self._commit(batch)
+            if stop:
+                return
+
+    async def _commit(self, batch):
+        results = []
+        try:
+            async with self.Session() as session:
+                if session.bind.dialect.name == 'sqlite':
+                    # Блокировка записи сразу, а не при первом INSERT: иначе транзакция,
+                    # начавшаяся с чтения, может получить SQLITE_BUSY без ожидания
+                    await session.execute(text("BEGIN IMMEDIATE"))
+                for op, future in batch:
+                    if future.cancelled():
+                        continue
+                    try:
+                        async with session.begin_nested():
+                            result = await op(session)
+                        results.append((future, result))
+                    except Exception as e:
+                        future.set_exception(e)
+                await session.commit()
+        except Exception as e:
+            logging.error(f"Ошибка фиксации пачки записей ({len(batch)} операций): {e}")
+            for future, _ in results:
+                if not future.done():
+                    future.set_exception(e)
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for future, result in results:
+            if not future.done():
+                future.set_result(result)